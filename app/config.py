@@ -2,56 +2,96 @@
 Configuration du bot de détection de fake news et deepfakes
 """
 import os
+from dataclasses import dataclass
+from typing import Optional
 from dotenv import load_dotenv
 
-load_dotenv()
+# Charger le .env une seule fois : les processus workers héritent de
+# l'environnement déjà peuplé et n'ont pas à re-parser le fichier
+if not os.environ.get("_DOTENV_LOADED"):
+    load_dotenv()
+    os.environ["_DOTENV_LOADED"] = "1"
 
 
-class Config:
+@dataclass(frozen=True, slots=True)
+class _Config:
+    """
+    Configuration immuable, lue une seule fois depuis l'environnement
+    à l'import (instance unique : `Config`)
+    """
     # Meta / WhatsApp Cloud API
-    WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
-    PHONE_NUMBER_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID")
-    VERIFY_TOKEN = os.getenv("WHATSAPP_VERIFY_TOKEN", "verify_me_fakenews_2025")
+    WHATSAPP_TOKEN: Optional[str] = os.getenv("WHATSAPP_TOKEN")
+    PHONE_NUMBER_ID: Optional[str] = os.getenv("WHATSAPP_PHONE_NUMBER_ID")
+    VERIFY_TOKEN: str = os.getenv("WHATSAPP_VERIFY_TOKEN", "verify_me_fakenews_2025")
+    
+    # Secret de l'application Meta (vérification de X-Hub-Signature-256)
+    APP_SECRET: Optional[str] = os.getenv("WHATSAPP_APP_SECRET")
     
     # Version API Meta
-    API_VERSION = os.getenv("API_VERSION", "v21.0")
+    API_VERSION: str = os.getenv("API_VERSION", "v21.0")
     
     # Hugging Face Models
     # Modèle pour la détection de fake news (texte)
-    FAKE_NEWS_MODEL = os.getenv(
+    FAKE_NEWS_MODEL: str = os.getenv(
         "FAKE_NEWS_MODEL",
         "hamzab/roberta-fake-news-classification"  # Modèle léger et performant
     )
     
+    # Quantification dynamique INT8 du modèle de fake news (CPU)
+    FAKE_NEWS_QUANTIZE: bool = os.getenv("FAKE_NEWS_QUANTIZE", "True").lower() == "true"
+    
     # Modèle pour la détection de deepfakes (images)
-    DEEPFAKE_IMAGE_MODEL = os.getenv(
+    DEEPFAKE_IMAGE_MODEL: str = os.getenv(
         "DEEPFAKE_IMAGE_MODEL",
         "dima806/deepfake_vs_real_image_detection"
     )
     
+    # Cache des poids des modèles (safetensors partagés entre workers via mmap)
+    MODEL_CACHE_DIR: str = os.getenv("MODEL_CACHE_DIR", "models")
+    
     # API Hugging Face (optionnel, pour Inference API)
-    HF_API_KEY = os.getenv("HF_API_KEY", "")
+    HF_API_KEY: str = os.getenv("HF_API_KEY", "")
     
     # Serveur
-    HOST = os.getenv("HOST", "0.0.0.0")
-    PORT = int(os.getenv("PORT", "8000"))
-    DEBUG = os.getenv("DEBUG", "False").lower() == "true"
+    HOST: str = os.getenv("HOST", "0.0.0.0")
+    PORT: int = int(os.getenv("PORT", "8000"))
+    DEBUG: bool = os.getenv("DEBUG", "False").lower() == "true"
+    
+    # Logs au format JSON (une ligne par événement, champs `extra` inclus)
+    LOG_JSON: bool = os.getenv("LOG_JSON", "False").lower() == "true"
+    WEB_CONCURRENCY: int = int(os.getenv("WEB_CONCURRENCY", "2"))
     
     # Seuils de détection
-    FAKE_NEWS_THRESHOLD = float(os.getenv("FAKE_NEWS_THRESHOLD", "0.6"))
-    DEEPFAKE_THRESHOLD = float(os.getenv("DEEPFAKE_THRESHOLD", "0.7"))
+    FAKE_NEWS_THRESHOLD: float = float(os.getenv("FAKE_NEWS_THRESHOLD", "0.6"))
+    DEEPFAKE_THRESHOLD: float = float(os.getenv("DEEPFAKE_THRESHOLD", "0.7"))
     
     # Taille maximale des médias (en MB)
-    MAX_MEDIA_SIZE_MB = int(os.getenv("MAX_MEDIA_SIZE_MB", "16"))
+    MAX_MEDIA_SIZE_MB: int = int(os.getenv("MAX_MEDIA_SIZE_MB", "16"))
     
     # Dossier temporaire pour les médias
-    TEMP_MEDIA_DIR = os.getenv("TEMP_MEDIA_DIR", "/tmp/whatsapp_media")
+    TEMP_MEDIA_DIR: str = os.getenv("TEMP_MEDIA_DIR", "/tmp/whatsapp_media")
     
     # Timeout pour les analyses
-    ANALYSIS_TIMEOUT = int(os.getenv("ANALYSIS_TIMEOUT", "30"))
+    ANALYSIS_TIMEOUT: int = int(os.getenv("ANALYSIS_TIMEOUT", "30"))
+
+    # Micro-batching des analyses de texte (requêtes regroupées par lot)
+    FAKE_NEWS_BATCH_SIZE: int = int(os.getenv("FAKE_NEWS_BATCH_SIZE", "8"))
+    FAKE_NEWS_BATCH_WINDOW_MS: int = int(os.getenv("FAKE_NEWS_BATCH_WINDOW_MS", "20"))
+    
+    # Nombre de résultats d'analyse de texte gardés en cache (messages transférés)
+    FAKE_NEWS_CACHE_SIZE: int = int(os.getenv("FAKE_NEWS_CACHE_SIZE", "2048"))
+    
+    # Nombre de résultats d'analyse de médias gardés en cache (par empreinte du fichier)
+    MEDIA_CACHE_SIZE: int = int(os.getenv("MEDIA_CACHE_SIZE", "512"))
+    
+    # Nombre maximal de messages traités simultanément (analyses, téléchargements)
+    MAX_CONCURRENT_MESSAGES: int = int(os.getenv("MAX_CONCURRENT_MESSAGES", "32"))
+    
+    # Taille maximale du corps d'un webhook (en KB), vérifiée avant le décodage
+    MAX_WEBHOOK_BODY_KB: int = int(os.getenv("MAX_WEBHOOK_BODY_KB", "512"))
     
     # Messages du bot
-    WELCOME_MESSAGE = """👋 Bienvenue sur le Bot de Vérification !
+    WELCOME_MESSAGE: str = """👋 Bienvenue sur le Bot de Vérification !
 
 🔍 Je peux vous aider à analyser :
 • 📝 Textes (fake news)
@@ -63,7 +103,7 @@ Envoyez-moi simplement le contenu à vérifier !
 
 ⚠️ Note : Cette analyse automatique n'est pas infaillible. Utilisez votre jugement critique !"""
 
-    HELP_MESSAGE = """ℹ️ Comment utiliser ce bot :
+    HELP_MESSAGE: str = """ℹ️ Comment utiliser ce bot :
 
 1️⃣ Envoyez un texte à vérifier
    → Je l'analyserai pour détecter des fake news
@@ -75,7 +115,7 @@ Envoyez-moi simplement le contenu à vérifier !
    
 🔒 Vos données sont analysées localement et ne sont pas conservées."""
 
-    INFO_MESSAGE = """🔬 Détails Techniques :
+    INFO_MESSAGE: str = """🔬 Détails Techniques :
 
 **Analyse de Texte :**
 • Modèle : RoBERTa finetuné
@@ -94,13 +134,12 @@ Envoyez-moi simplement le contenu à vérifier !
 
 💡 Toujours vérifier les sources !"""
 
-    @classmethod
-    def validate(cls):
+    def validate(self):
         """Valide que les variables essentielles sont présentes"""
         missing = []
-        if not cls.WHATSAPP_TOKEN:
+        if not self.WHATSAPP_TOKEN:
             missing.append("WHATSAPP_TOKEN")
-        if not cls.PHONE_NUMBER_ID:
+        if not self.PHONE_NUMBER_ID:
             missing.append("WHATSAPP_PHONE_NUMBER_ID")
         if missing:
             raise RuntimeError(
@@ -108,7 +147,9 @@ Envoyez-moi simplement le contenu à vérifier !
                 "Créez un fichier .env avec ces variables."
             )
     
-    @classmethod
-    def create_temp_dir(cls):
+    def create_temp_dir(self):
         """Création le dossier temporaire pour les médias"""
-        os.makedirs(cls.TEMP_MEDIA_DIR, exist_ok=True)
\ No newline at end of file
+        os.makedirs(self.TEMP_MEDIA_DIR, exist_ok=True)
+
+
+Config = _Config()
\ No newline at end of file
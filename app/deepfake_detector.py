@@ -1,19 +1,35 @@
 """
 Détecteur de deepfakes pour images, vidéos et audios
 """
-from transformers import pipeline
+from transformers import pipeline, AutoImageProcessor, AutoModelForImageClassification
 from PIL import Image
 import cv2
 import numpy as np
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
 import asyncio
+import hashlib
 import os
+import threading
 
 from app.config import Config
-from app.utils import setup_logger, get_media_type_from_mime
+from app.utils import setup_logger, get_media_type_from_mime, share_model_weights
 
 logger = setup_logger(__name__)
 
+# Taille maximale (plus grand côté, en pixels) des images analysées.
+# Les modèles redimensionnent de toute façon en 224px et les statistiques
+# de l'analyse basique sont des ratios, indépendants de la résolution.
+MAX_ANALYSIS_SIDE = 512
+
+# Nombre de frames échantillonnées par vidéo
+VIDEO_SAMPLE_FRAMES = 5
+
+# En dessous de ce nombre de frames, une lecture séquentielle unique coûte
+# moins que des seeks (chacun re-décode depuis la keyframe précédente) ;
+# au-delà, on se positionne directement sur chaque frame échantillonnée
+SEQUENTIAL_SCAN_MAX_FRAMES = 300
+
 
 class DeepfakeDetector:
     """Détecteur de deepfakes multi-modal"""
@@ -23,6 +39,20 @@ class DeepfakeDetector:
         self.threshold = Config.DEEPFAKE_THRESHOLD
         self.image_pipeline = None
         self._initialized = False
+        self._load_lock = threading.Lock()
+        
+        # Cache LRU des résultats, indexé par hash du contenu du fichier :
+        # un même média transféré des milliers de fois n'est analysé qu'une fois
+        self._media_cache: "OrderedDict[Tuple[str, bytes], Dict[str, any]]" = OrderedDict()
+        self._media_cache_max = Config.MEDIA_CACHE_SIZE
+        
+        # Table de dispatch type de média -> analyseur
+        self._dispatch = {
+            "image": self.analyze_image,
+            "video": self.analyze_video,
+            "audio": self.analyze_audio,
+        }
+        
         logger.info("Initialisation du détecteur de deepfakes")
     
     def _lazy_load_image_model(self):
@@ -30,23 +60,40 @@ class DeepfakeDetector:
         if self._initialized:
             return
         
-        try:
-            logger.info(f"Chargement du modèle deepfake image: {self.image_model_name}")
-            
-            # Charger le pipeline de classification d'images
-            self.image_pipeline = pipeline(
-                "image-classification",
-                model=self.image_model_name,
-                device=-1  # CPU
-            )
-            
-            self._initialized = True
-            logger.info("✅ Modèle deepfake image chargé")
-            
-        except Exception as e:
-            logger.error(f"❌ Erreur chargement modèle: {e}")
-            # Continuer sans modèle (analyse basique)
-            self._initialized = True
+        # Un seul chargement même si le préchargement (thread) et une
+        # première requête arrivent en même temps
+        with self._load_lock:
+            if self._initialized:
+                return
+            
+            try:
+                logger.info(f"Chargement du modèle deepfake image: {self.image_model_name}")
+                
+                # Charger le modèle (poids partagés entre workers) et son processeur
+                image_processor = AutoImageProcessor.from_pretrained(self.image_model_name)
+                model = AutoModelForImageClassification.from_pretrained(self.image_model_name)
+                model = share_model_weights(model, self.image_model_name)
+                model.eval()
+                
+                # Charger le pipeline de classification d'images
+                self.image_pipeline = pipeline(
+                    "image-classification",
+                    model=model,
+                    image_processor=image_processor,
+                    device=-1  # CPU
+                )
+                
+                self._initialized = True
+                logger.info("✅ Modèle deepfake image chargé")
+                
+            except Exception as e:
+                logger.error(f"❌ Erreur chargement modèle: {e}")
+                # Continuer sans modèle (analyse basique)
+                self._initialized = True
+    
+    def warm_up(self) -> None:
+        """Charge le modèle à l'avance (au démarrage, dans un thread)"""
+        self._lazy_load_image_model()
     
     async def analyze_media(
         self,
@@ -66,12 +113,27 @@ class DeepfakeDetector:
         media_type = get_media_type_from_mime(mime_type)
         
         try:
-            if media_type == "image":
-                return await self.analyze_image(file_path)
-            elif media_type == "video":
-                return await self.analyze_video(file_path)
-            elif media_type == "audio":
-                return await self.analyze_audio(file_path)
+            handler = self._dispatch.get(media_type)
+            if handler:
+                loop = asyncio.get_event_loop()
+                digest = await loop.run_in_executor(None, self._hash_file, file_path)
+                key = (media_type, digest)
+                
+                cached = self._media_cache.get(key)
+                if cached is not None:
+                    self._media_cache.move_to_end(key)
+                    logger.info(f"Résultat {media_type} servi depuis le cache")
+                    return cached
+                
+                result = await handler(file_path)
+                
+                # Ne pas mettre en cache les erreurs (souvent transitoires)
+                if not result.get("error"):
+                    self._media_cache[key] = result
+                    if len(self._media_cache) > self._media_cache_max:
+                        self._media_cache.popitem(last=False)
+                
+                return result
             else:
                 return {
                     "is_fake": False,
@@ -86,9 +148,26 @@ class DeepfakeDetector:
                 "is_fake": False,
                 "confidence": 0.0,
                 "media_type": media_type,
-                "details": f"Erreur d'analyse: {str(e)}"
+                "details": f"Erreur d'analyse: {str(e)}",
+                "error": True
             }
     
+    def _hash_file(self, file_path: str) -> bytes:
+        """
+        Calcule l'empreinte BLAKE2b d'un fichier (lecture par blocs)
+        
+        Args:
+            file_path: Chemin du fichier
+            
+        Returns:
+            Empreinte binaire (16 octets)
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.digest()
+    
     async def analyze_image(self, image_path: str) -> Dict[str, any]:
         """
         Analyse une image pour détecter les deepfakes
@@ -100,19 +179,22 @@ class DeepfakeDetector:
             Dict avec les résultats
         """
         try:
-            # Lazy loading du modèle
+            # Lazy loading du modèle (dans un thread : ne bloque pas la boucle)
             if not self._initialized:
-                self._lazy_load_image_model()
+                await asyncio.to_thread(self._lazy_load_image_model)
             
             # Vérifier que le fichier existe
             if not os.path.exists(image_path):
                 raise FileNotFoundError(f"Image non trouvée: {image_path}")
             
-            # Charger l'image
-            image = Image.open(image_path).convert("RGB")
-            
             # Analyse avec le modèle si disponible
             if self.image_pipeline:
+                # Charger l'image (réduite avant conversion : le décodeur JPEG
+                # peut alors décoder directement à plus basse résolution)
+                image = Image.open(image_path)
+                image.thumbnail((MAX_ANALYSIS_SIDE, MAX_ANALYSIS_SIDE))
+                image = image.convert("RGB")
+                
                 loop = asyncio.get_event_loop()
                 result = await loop.run_in_executor(
                     None,
@@ -120,8 +202,13 @@ class DeepfakeDetector:
                     image
                 )
             else:
-                # Analyse basique sans modèle
-                result = await self._analyze_image_basic(image_path)
+                # Analyse basique sans modèle (chargement avec OpenCV)
+                img = cv2.imread(image_path)
+                
+                if img is None:
+                    raise ValueError("Impossible de charger l'image")
+                
+                result = await self._analyze_image_basic(img)
             
             result["media_type"] = "image"
             return result
@@ -132,7 +219,8 @@ class DeepfakeDetector:
                 "is_fake": False,
                 "confidence": 0.0,
                 "media_type": "image",
-                "details": f"Erreur: {str(e)}"
+                "details": f"Erreur: {str(e)}",
+                "error": True
             }
     
     def _analyze_image_with_model(self, image: Image.Image) -> Dict[str, any]:
@@ -149,57 +237,86 @@ class DeepfakeDetector:
             # Prédiction
             predictions = self.image_pipeline(image, top_k=2)
             
-            # Parser les résultats
-            top = predictions[0]
-            label = top["label"].upper()
-            score = top["score"]
-            
-            # Déterminer si c'est un deepfake
-            is_fake = label in ["FAKE", "DEEPFAKE", "LABEL_1", "1", "MANIPULATED"]
-            
-            details = []
-            details.append(f"• Prédiction: {label} ({int(score*100)}%)")
+            return self._parse_image_predictions(predictions)
             
-            if len(predictions) > 1:
-                alt = predictions[1]
-                details.append(f"• Alternative: {alt['label']} ({int(alt['score']*100)}%)")
+        except Exception as e:
+            logger.error(f"Erreur dans _analyze_image_with_model: {e}")
+            raise
+    
+    def _analyze_images_with_model(self, images: List[Image.Image]) -> List[Dict[str, any]]:
+        """
+        Analyse plusieurs images en un seul passage du modèle (batch)
+        
+        Args:
+            images: Images PIL
             
-            if is_fake:
-                details.append("• Signes potentiels de manipulation détectés")
-                details.append("• Vérifiez la source originale de l'image")
-            else:
-                details.append("• L'image semble authentique")
-                details.append("• Aucun signe évident de manipulation IA")
+        Returns:
+            Liste de dicts avec les résultats, dans l'ordre des images
+        """
+        try:
+            # Prédiction groupée
+            all_predictions = self.image_pipeline(
+                images,
+                top_k=2,
+                batch_size=len(images)
+            )
             
-            return {
-                "is_fake": is_fake,
-                "confidence": score,
-                "label": label,
-                "details": "\n".join(details),
-                "all_predictions": predictions
-            }
+            return [self._parse_image_predictions(p) for p in all_predictions]
             
         except Exception as e:
-            logger.error(f"Erreur dans _analyze_image_with_model: {e}")
+            logger.error(f"Erreur dans _analyze_images_with_model: {e}")
             raise
     
-    async def _analyze_image_basic(self, image_path: str) -> Dict[str, any]:
+    def _parse_image_predictions(self, predictions: list) -> Dict[str, any]:
+        """
+        Parse les prédictions du modèle d'images
+        
+        Args:
+            predictions: Résultats bruts du modèle pour une image
+            
+        Returns:
+            Dict formaté avec les résultats
+        """
+        top = predictions[0]
+        label = top["label"].upper()
+        score = top["score"]
+        
+        # Déterminer si c'est un deepfake
+        is_fake = label in ["FAKE", "DEEPFAKE", "LABEL_1", "1", "MANIPULATED"]
+        
+        details = []
+        details.append(f"• Prédiction: {label} ({int(score*100)}%)")
+        
+        if len(predictions) > 1:
+            alt = predictions[1]
+            details.append(f"• Alternative: {alt['label']} ({int(alt['score']*100)}%)")
+        
+        if is_fake:
+            details.append("• Signes potentiels de manipulation détectés")
+            details.append("• Vérifiez la source originale de l'image")
+        else:
+            details.append("• L'image semble authentique")
+            details.append("• Aucun signe évident de manipulation IA")
+        
+        return {
+            "is_fake": is_fake,
+            "confidence": score,
+            "label": label,
+            "details": "\n".join(details),
+            "all_predictions": predictions
+        }
+    
+    async def _analyze_image_basic(self, img: np.ndarray) -> Dict[str, any]:
         """
         Analyse basique d'image sans modèle ML (analyse des artefacts)
         
         Args:
-            image_path: Chemin de l'image
+            img: Image OpenCV (BGR)
             
         Returns:
             Dict avec les résultats
         """
         try:
-            # Charger l'image avec OpenCV
-            img = cv2.imread(image_path)
-            
-            if img is None:
-                raise ValueError("Impossible de charger l'image")
-            
             # Analyses basiques
             details = []
             suspicious_score = 0
@@ -208,8 +325,20 @@ class DeepfakeDetector:
             height, width = img.shape[:2]
             details.append(f"• Résolution: {width}x{height}")
             
+            # Réduire l'image pour borner le coût des filtres
+            scale = MAX_ANALYSIS_SIDE / max(height, width)
+            if scale < 1:
+                img = cv2.resize(
+                    img,
+                    (int(width * scale), int(height * scale)),
+                    interpolation=cv2.INTER_AREA
+                )
+            
+            # Niveaux de gris et statistiques calculés une seule fois
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            jpeg_quality, edge_score = self._compute_image_stats(gray)
+            
             # 2. Analyser les artefacts JPEG
-            jpeg_quality = self._estimate_jpeg_quality(img)
             details.append(f"• Qualité estimée: {jpeg_quality}%")
             
             if jpeg_quality < 70:
@@ -217,7 +346,6 @@ class DeepfakeDetector:
                 details.append("• ⚠️ Qualité faible (possibles compressions multiples)")
             
             # 3. Analyser les bords (artefacts GAN typiques)
-            edge_score = self._analyze_edges(img)
             if edge_score > 0.7:
                 suspicious_score += 0.3
                 details.append("• ⚠️ Artefacts de bords détectés")
@@ -242,33 +370,35 @@ class DeepfakeDetector:
             logger.error(f"Erreur analyse basique: {e}")
             raise
     
-    def _estimate_jpeg_quality(self, img: np.ndarray) -> int:
-        """Estime la qualité JPEG (méthode approximative)"""
-        try:
-            # Convertir en niveaux de gris
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            
-            # Calculer le bruit
-            laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
+    def _compute_image_stats(self, gray: np.ndarray) -> Tuple[int, float]:
+        """
+        Calcule en une passe les statistiques de l'analyse basique
+        
+        Args:
+            gray: Image en niveaux de gris
             
-            # Estimer la qualité (approximation)
+        Returns:
+            Tuple (qualité JPEG estimée en %, ratio de pixels de bord)
+        """
+        # Qualité JPEG (méthode approximative) : variance du Laplacien.
+        # CV_32F suffit (|Laplacien| <= 8*255) et meanStdDev calcule la
+        # variance en une seule passe C, sans tableau temporaire numpy.
+        try:
+            laplacian = cv2.Laplacian(gray, cv2.CV_32F)
+            _, stddev = cv2.meanStdDev(laplacian)
+            laplacian_var = float(stddev[0][0]) ** 2
             quality = min(100, max(0, int(laplacian_var / 10)))
-            return quality
         except:
-            return 75  # Valeur par défaut
-    
-    def _analyze_edges(self, img: np.ndarray) -> float:
-        """Analyse les artefacts de bords (typiques des GAN)"""
+            quality = 75  # Valeur par défaut
+        
+        # Artefacts de bords (typiques des GAN) : ratio de pixels de bord
         try:
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
             edges = cv2.Canny(gray, 50, 150)
-            
-            # Calculer le ratio de pixels de bord
-            edge_ratio = np.sum(edges > 0) / edges.size
-            
-            return edge_ratio
+            edge_ratio = np.count_nonzero(edges) / edges.size
         except:
-            return 0.0
+            edge_ratio = 0.0
+        
+        return quality, edge_ratio
     
     async def analyze_video(self, video_path: str) -> Dict[str, any]:
         """
@@ -283,43 +413,34 @@ class DeepfakeDetector:
         try:
             logger.info(f"Analyse vidéo: {video_path}")
             
-            # Ouvrir la vidéo
-            cap = cv2.VideoCapture(video_path)
-            
-            if not cap.isOpened():
-                raise ValueError("Impossible d'ouvrir la vidéo")
-            
-            # Extraire quelques frames
-            total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            fps = cap.get(cv2.CAP_PROP_FPS)
+            # Lazy loading du modèle (dans un thread : ne bloque pas la boucle)
+            if not self._initialized:
+                await asyncio.to_thread(self._lazy_load_image_model)
+            
+            # Extraire les frames échantillonnées (décodage et conversion en
+            # images PIL pour le modèle, dans un thread)
+            use_model = self.image_pipeline is not None
+            frames, frame_indices, total_frames, fps = await asyncio.to_thread(
+                self._extract_video_frames,
+                video_path,
+                use_model
+            )
             duration = total_frames / fps if fps > 0 else 0
             
-            # Analyser 5 frames échantillonnées
-            frame_indices = np.linspace(0, total_frames - 1, min(5, total_frames), dtype=int)
-            
-            fake_count = 0
-            confidences = []
-            
-            for idx in frame_indices:
-                cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
-                ret, frame = cap.read()
-                
-                if ret:
-                    # Sauvegarder temporairement la frame
-                    temp_frame = f"/tmp/frame_{idx}.jpg"
-                    cv2.imwrite(temp_frame, frame)
-                    
-                    # Analyser la frame
-                    result = await self.analyze_image(temp_frame)
-                    
-                    if result["is_fake"]:
-                        fake_count += 1
-                    confidences.append(result["confidence"])
-                    
-                    # Nettoyer
-                    os.remove(temp_frame)
+            # Analyser les frames directement en mémoire
+            if use_model and frames:
+                # Un seul appel batché du modèle pour toutes les frames
+                loop = asyncio.get_event_loop()
+                results = await loop.run_in_executor(
+                    None,
+                    self._analyze_images_with_model,
+                    frames
+                )
+            else:
+                results = [await self._analyze_image_basic(frame) for frame in frames]
             
-            cap.release()
+            fake_count = sum(1 for result in results if result["is_fake"])
+            confidences = [result["confidence"] for result in results]
             
             # Verdict global
             is_fake = fake_count >= 2  # Au moins 2 frames suspectes
@@ -350,9 +471,79 @@ class DeepfakeDetector:
                 "is_fake": False,
                 "confidence": 0.0,
                 "media_type": "video",
-                "details": f"Erreur: {str(e)}"
+                "details": f"Erreur: {str(e)}",
+                "error": True
             }
     
+    def _extract_video_frames(
+        self,
+        video_path: str,
+        as_pil: bool = False
+    ) -> Tuple[list, np.ndarray, int, float]:
+        """
+        Extrait quelques frames réparties sur la vidéo (méthode synchrone)
+        
+        Args:
+            video_path: Chemin de la vidéo
+            as_pil: Convertir les frames en images PIL RGB réduites (entrée du modèle)
+            
+        Returns:
+            Tuple (frames BGR ou PIL, indices échantillonnés, nombre total de frames, fps)
+        """
+        cap = cv2.VideoCapture(video_path)
+        
+        if not cap.isOpened():
+            raise ValueError("Impossible d'ouvrir la vidéo")
+        
+        try:
+            total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            fps = cap.get(cv2.CAP_PROP_FPS)
+            
+            frame_indices = np.linspace(
+                0,
+                total_frames - 1,
+                min(VIDEO_SAMPLE_FRAMES, total_frames),
+                dtype=int
+            )
+            frames = []
+            
+            if total_frames <= SEQUENTIAL_SCAN_MAX_FRAMES:
+                # Vidéo courte : lecture séquentielle unique ; grab() avance,
+                # retrieve() ne convertit que les frames retenues
+                wanted = set(frame_indices.tolist())
+                idx = 0
+                while len(frames) < len(wanted):
+                    if not cap.grab():
+                        break
+                    
+                    if idx in wanted:
+                        ret, frame = cap.retrieve()
+                        if ret:
+                            frames.append(frame)
+                    
+                    idx += 1
+            else:
+                # Vidéo longue : un seek par frame échantillonnée plutôt que
+                # de décoder toute la vidéo
+                for frame_idx in frame_indices:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, int(frame_idx))
+                    ret, frame = cap.read()
+                    if ret:
+                        frames.append(frame)
+            
+            if as_pil:
+                pil_frames = []
+                for frame in frames:
+                    pil_frame = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                    pil_frame.thumbnail((MAX_ANALYSIS_SIDE, MAX_ANALYSIS_SIDE))
+                    pil_frames.append(pil_frame)
+                frames = pil_frames
+            
+            return frames, frame_indices, total_frames, fps
+            
+        finally:
+            cap.release()
+    
     async def analyze_audio(self, audio_path: str) -> Dict[str, any]:
         """
         Analyse un audio (détection voix synthétique)
@@ -369,9 +560,16 @@ class DeepfakeDetector:
             
             logger.info(f"Analyse audio: {audio_path}")
             
-            # Charger l'audio
-            y, sr = librosa.load(audio_path, sr=None)
-            duration = librosa.get_duration(y=y, sr=sr)
+            # Charger l'audio directement avec libsndfile (C) ; repli sur
+            # librosa/audioread pour les formats non supportés (aac, m4a...)
+            try:
+                y, sr = sf.read(audio_path, dtype="float32", always_2d=False)
+                if y.ndim > 1:
+                    y = y.mean(axis=1)
+            except RuntimeError:
+                y, sr = librosa.load(audio_path, sr=None)
+            
+            duration = len(y) / sr
             
             # Analyses basiques
             details = [
@@ -406,5 +604,6 @@ class DeepfakeDetector:
                 "is_fake": False,
                 "confidence": 0.0,
                 "media_type": "audio",
-                "details": f"Analyse audio non disponible: {str(e)}"
+                "details": f"Analyse audio non disponible: {str(e)}",
+                "error": True
             }
\ No newline at end of file
@@ -1,14 +1,34 @@
 """
 Détecteur de fake news utilisant des modèles NLP de Hugging Face
 """
+import os
+
+# Évite les avertissements (et la sur-souscription CPU) des tokenizers Rust
+# avec les workers gunicorn ; doit être défini avant l'import de transformers
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
 from transformers import pipeline, AutoTokenizer, AutoModelForSequenceClassification
-from typing import Tuple, Dict
+import torch
+from typing import Tuple, Dict, List, Optional
+from collections import OrderedDict
 from app.config import Config
-from app.utils import setup_logger
+from app.utils import setup_logger, share_model_weights
 import asyncio
+import hashlib
+import threading
 
 logger = setup_logger(__name__)
 
+# Labels "authentique" possibles selon le modèle
+REAL_LABELS = frozenset({"REAL", "LABEL_0", "0", "RELIABLE"})
+
+# Détails pré-calculés du cas le plus fréquent : contenu authentique, confiance > 90%
+HIGH_CONFIDENCE_REAL_DETAILS = (
+    "• Confiance très élevée dans l'analyse\n"
+    "• Le contenu semble authentique mais restez vigilant\n"
+    "• Vérifiez toujours le contexte et la date"
+)
+
 
 class FakeNewsDetector:
     """Détecteur de fake news basé sur des modèles NLP"""
@@ -18,6 +38,19 @@ class FakeNewsDetector:
         self.threshold = Config.FAKE_NEWS_THRESHOLD
         self.pipeline = None
         self._initialized = False
+        self._load_lock = threading.Lock()
+        
+        # Micro-batching : les requêtes concurrentes sont regroupées en un seul
+        # passage du modèle
+        self.batch_size = max(1, Config.FAKE_NEWS_BATCH_SIZE)
+        self.batch_window = Config.FAKE_NEWS_BATCH_WINDOW_MS / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        
+        # Cache LRU des résultats, indexé par hash du texte
+        self._cache: "OrderedDict[bytes, Dict[str, any]]" = OrderedDict()
+        self._cache_max = Config.FAKE_NEWS_CACHE_SIZE
+        
         logger.info(f"Initialisation du détecteur de fake news: {self.model_name}")
     
     def _lazy_load_model(self):
@@ -25,24 +58,68 @@ class FakeNewsDetector:
         if self._initialized:
             return
         
-        try:
-            logger.info("Chargement du modèle de fake news...")
-            
-            # Charger le modèle et le tokenizer
-            self.pipeline = pipeline(
-                "text-classification",
-                model=self.model_name,
-                device=-1,  # CPU (0 pour GPU si disponible)
-                truncation=True,
-                max_length=512
-            )
-            
-            self._initialized = True
-            logger.info("✅ Modèle de fake news chargé avec succès")
+        # Un seul chargement même si le préchargement (thread) et une
+        # première requête arrivent en même temps
+        with self._load_lock:
+            if self._initialized:
+                return
             
-        except Exception as e:
-            logger.error(f"❌ Erreur lors du chargement du modèle: {e}")
-            raise
+            try:
+                logger.info("Chargement du modèle de fake news...")
+                
+                # Limiter les threads intra-op pour ne pas sur-souscrire le CPU
+                # lorsque plusieurs workers/exécuteurs tournent en parallèle
+                torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+                try:
+                    torch.set_num_interop_threads(1)
+                except RuntimeError:
+                    # Ne peut être appelé qu'une fois par processus
+                    pass
+                
+                # Charger le modèle et le tokenizer
+                tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+                model = AutoModelForSequenceClassification.from_pretrained(self.model_name)
+                model = share_model_weights(model, self.model_name)
+                model.eval()
+                
+                # Quantification dynamique INT8 des couches linéaires
+                # (moitié moins de mémoire, GEMM int8 sur CPU). inplace=True :
+                # sans copie profonde du modèle, seules les couches Linear sont
+                # reconditionnées, embeddings et LayerNorm restent sur le
+                # fichier safetensors mappé (partagé entre workers)
+                if Config.FAKE_NEWS_QUANTIZE:
+                    try:
+                        model = torch.quantization.quantize_dynamic(
+                            model,
+                            {torch.nn.Linear},
+                            dtype=torch.qint8,
+                            inplace=True
+                        )
+                        logger.info("Modèle de fake news quantifié en INT8")
+                    except Exception as e:
+                        # Pas de moteur quantifié sur ce CPU, couche non supportée... :
+                        # on garde le modèle FP32
+                        logger.warning(f"⚠️ Quantification INT8 impossible, modèle FP32 conservé: {e}")
+                
+                self.pipeline = pipeline(
+                    "text-classification",
+                    model=model,
+                    tokenizer=tokenizer,
+                    device=-1,  # CPU (0 pour GPU si disponible)
+                    truncation=True,
+                    max_length=512
+                )
+                
+                self._initialized = True
+                logger.info("✅ Modèle de fake news chargé avec succès")
+                
+            except Exception as e:
+                logger.error(f"❌ Erreur lors du chargement du modèle: {e}")
+                raise
+    
+    def warm_up(self) -> None:
+        """Charge le modèle à l'avance (au démarrage, dans un thread)"""
+        self._lazy_load_model()
     
     async def analyze_text(self, text: str) -> Dict[str, any]:
         """
@@ -55,9 +132,9 @@ class FakeNewsDetector:
             Dict avec les résultats de l'analyse
         """
         try:
-            # Lazy loading du modèle
+            # Lazy loading du modèle (dans un thread : ne bloque pas la boucle)
             if not self._initialized:
-                self._lazy_load_model()
+                await asyncio.to_thread(self._lazy_load_model)
             
             # Valider le texte
             if not text or len(text.strip()) < 10:
@@ -71,9 +148,22 @@ class FakeNewsDetector:
             # Limiter la longueur
             text = text[:5000]
             
-            # Analyser avec le modèle
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(None, self._analyze_with_model, text)
+            # Les messages viraux sont transférés à l'identique : cache exact
+            key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return cached
+            
+            # Analyser avec le modèle (via la file de micro-batching)
+            self._ensure_worker()
+            future = asyncio.get_event_loop().create_future()
+            await self._queue.put((text, future))
+            result = await future
+            
+            self._cache[key] = result
+            if len(self._cache) > self._cache_max:
+                self._cache.popitem(last=False)
             
             return result
             
@@ -86,27 +176,80 @@ class FakeNewsDetector:
                 "details": f"Erreur d'analyse: {str(e)}"
             }
     
-    def _analyze_with_model(self, text: str) -> Dict[str, any]:
+    def _ensure_worker(self) -> None:
+        """Démarre la tâche de micro-batching si elle ne tourne pas déjà"""
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._batch_worker())
+    
+    async def _batch_worker(self) -> None:
+        """
+        Regroupe les textes arrivant dans une courte fenêtre de temps et les
+        analyse en un seul appel du pipeline
+        """
+        loop = asyncio.get_event_loop()
+        
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+            
+            # Attendre d'autres textes jusqu'à remplir le lot ou expiration
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            texts = [text for text, _ in batch]
+            
+            try:
+                results = await loop.run_in_executor(
+                    None,
+                    self._analyze_batch_with_model,
+                    texts
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+    
+    def _analyze_batch_with_model(self, texts: List[str]) -> List[Dict[str, any]]:
         """
-        Effectue l'analyse avec le modèle (méthode synchrone)
+        Effectue l'analyse d'un lot de textes avec le modèle (méthode synchrone)
         
         Args:
-            text: Texte à analyser
+            texts: Textes à analyser
             
         Returns:
-            Dict avec les résultats
+            Liste de dicts avec les résultats, dans l'ordre des textes
         """
         try:
-            # Prédiction
-            predictions = self.pipeline(text, top_k=2)
+            # Prédiction groupée : un seul passage du modèle pour tout le lot
+            # (inference_mode : pas de suivi autograd ni de compteurs de version)
+            with torch.inference_mode():
+                predictions = self.pipeline(
+                    texts,
+                    top_k=2,
+                    batch_size=len(texts),
+                    padding=True,
+                    truncation=True,
+                    max_length=512
+                )
             
             # Parser les résultats selon le format du modèle
-            result = self._parse_predictions(predictions)
-            
-            return result
+            return [self._parse_predictions(p) for p in predictions]
             
         except Exception as e:
-            logger.error(f"Erreur dans _analyze_with_model: {e}")
+            logger.error(f"Erreur dans _analyze_batch_with_model: {e}")
             raise
     
     def _parse_predictions(self, predictions: list) -> Dict[str, any]:
@@ -133,12 +276,22 @@ class FakeNewsDetector:
         label = top_prediction["label"].upper()
         score = top_prediction["score"]
         
+        # Cas courant : authentique avec très haute confiance, pas de détails à générer
+        if label in REAL_LABELS and score > 0.9:
+            return {
+                "is_fake": False,
+                "confidence": score,
+                "label": label,
+                "details": HIGH_CONFIDENCE_REAL_DETAILS + self._alternative_score_line(predictions),
+                "all_predictions": predictions if Config.DEBUG else None
+            }
+        
         # Déterminer si c'est fake
         # Le label peut être "FAKE", "REAL", "fake", "real", "0", "1", etc.
         is_fake = label in ["FAKE", "LABEL_1", "1", "UNRELIABLE"]
         
         # Si le modèle prédit "REAL" avec haute confiance, c'est pas fake
-        if label in ["REAL", "LABEL_0", "0", "RELIABLE"]:
+        if label in REAL_LABELS:
             is_fake = False
             # Inverser le score pour représenter la confiance que c'est réel
             confidence = score
@@ -153,7 +306,9 @@ class FakeNewsDetector:
             "confidence": confidence,
             "label": label,
             "details": details,
-            "all_predictions": predictions
+            # Prédictions brutes conservées uniquement en debug (sinon retenues
+            # inutilement dans le cache de résultats)
+            "all_predictions": predictions if Config.DEBUG else None
         }
     
     def _generate_details(
@@ -195,11 +350,22 @@ class FakeNewsDetector:
             details.append("• Vérifiez toujours le contexte et la date")
         
         # Afficher les scores alternatifs si disponibles
+        return "\n".join(details) + self._alternative_score_line(predictions)
+    
+    def _alternative_score_line(self, predictions: list) -> str:
+        """
+        Ligne de détail du score alternatif (deuxième prédiction)
+        
+        Args:
+            predictions: Toutes les prédictions (top_k=2)
+            
+        Returns:
+            Ligne précédée d'un saut de ligne, ou chaîne vide
+        """
         if len(predictions) > 1:
             alt = predictions[1]
-            details.append(f"• Score alternatif: {alt['label']} ({int(alt['score']*100)}%)")
-        
-        return "\n".join(details)
+            return f"\n• Score alternatif: {alt['label']} ({int(alt['score']*100)}%)"
+        return ""
     
     def get_analysis_summary(self, analysis: Dict[str, any]) -> str:
         """
@@ -215,19 +381,21 @@ class FakeNewsDetector:
         confidence = analysis["confidence"]
         details = analysis.get("details", "")
         
+        parts = []
+        
         if is_fake:
-            summary = f"🚨 **ALERTE FAKE NEWS POSSIBLE**\n\n"
-            summary += f"📊 Probabilité : {int(confidence * 100)}%\n\n"
-            summary += "Ce texte présente des caractéristiques typiques de désinformation.\n\n"
+            parts.append("🚨 **ALERTE FAKE NEWS POSSIBLE**\n\n")
+            parts.append(f"📊 Probabilité : {int(confidence * 100)}%\n\n")
+            parts.append("Ce texte présente des caractéristiques typiques de désinformation.\n\n")
         else:
-            summary += f"✅ **CONTENU PROBABLEMENT FIABLE**\n\n"
-            summary += f"📊 Probabilité : {int(confidence * 100)}%\n\n"
-            summary += "Ce texte ne présente pas de signes évidents de désinformation.\n\n"
+            parts.append("✅ **CONTENU PROBABLEMENT FIABLE**\n\n")
+            parts.append(f"📊 Probabilité : {int(confidence * 100)}%\n\n")
+            parts.append("Ce texte ne présente pas de signes évidents de désinformation.\n\n")
         
         if details:
-            summary += f"**Détails :**\n{details}\n\n"
+            parts.append(f"**Détails :**\n{details}\n\n")
         
-        summary += (
+        parts.append(
             "━━━━━━━━━━━━━━━━━━━━━\n"
             "⚠️ **Rappel Important :**\n"
             "Cette analyse automatique n'est pas infaillible.\n"
@@ -238,4 +406,4 @@ class FakeNewsDetector:
             "• La date et l'auteur"
         )
         
-        return summary
\ No newline at end of file
+        return "".join(parts)
\ No newline at end of file
@@ -1,14 +1,141 @@
 """
 Gestionnaire de téléchargement et traitement des médias WhatsApp
 """
+import aiofiles
+import asyncio
 import httpx
+import mimetypes
+import orjson
 import os
-from typing import Optional, Tuple
+import random
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
 from app.config import Config
-from app.utils import setup_logger, sanitize_filename, estimate_file_size_mb
+from app.utils import (
+    setup_logger,
+    sanitize_filename,
+    estimate_file_size_mb,
+    request_with_retry,
+    stream_with_retry,
+)
 
 logger = setup_logger(__name__)
 
+# Client HTTP partagé pour l'API média et les téléchargements (connexions
+# réutilisées), créé au premier appel et fermé à l'arrêt de l'application
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """
+    Retourne le client HTTP partagé pour les médias, en le créant si besoin
+    
+    Returns:
+        Client httpx réutilisé entre les téléchargements
+    """
+    global _client
+    
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            limits=httpx.Limits(max_keepalive_connections=16, max_connections=32),
+            headers={"Authorization": f"Bearer {Config.WHATSAPP_TOKEN}"}
+        )
+    
+    return _client
+
+
+async def close_client() -> None:
+    """Ferme le client HTTP partagé (à appeler à l'arrêt de l'application)"""
+    global _client
+    
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+# Limite des appels simultanés à l'API média / téléchargements
+_media_semaphore = asyncio.Semaphore(10)
+
+# Cache des URLs signées renvoyées par l'API Graph (durée de vie courte) :
+# media_id -> (expiration monotonic, url). Évite un aller-retour HTTPS pour
+# les webhooks dupliqués et les nouvelles tentatives.
+MEDIA_URL_TTL_SECONDS = 240
+MEDIA_URL_CACHE_SIZE = 1024
+_media_url_cache: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+# Un verrou par media_id pour ne faire qu'un seul appel en cas de requêtes
+# simultanées, avec le nombre de coroutines qui l'utilisent (le verrou n'est
+# retiré que lorsque plus personne ne le détient ni ne l'attend)
+_media_url_locks: Dict[str, asyncio.Lock] = {}
+_media_url_lock_users: Dict[str, int] = {}
+
+
+def _get_cached_media_url(media_id: str) -> Optional[str]:
+    """Retourne l'URL en cache pour un média si elle n'a pas expiré"""
+    entry = _media_url_cache.get(media_id)
+    if entry is None:
+        return None
+    
+    expires_at, url = entry
+    if expires_at < time.monotonic():
+        del _media_url_cache[media_id]
+        return None
+    
+    return url
+
+
+def _cache_media_url(media_id: str, url: str) -> None:
+    """Met en cache l'URL d'un média (éviction des plus anciennes)"""
+    _media_url_cache[media_id] = (time.monotonic() + MEDIA_URL_TTL_SECONDS, url)
+    _media_url_cache.move_to_end(media_id)
+    if len(_media_url_cache) > MEDIA_URL_CACHE_SIZE:
+        _media_url_cache.popitem(last=False)
+
+
+# Table MIME de la bibliothèque standard, chargée une fois par processus
+mimetypes.init()
+
+# Types que `mimetypes` ne connaît pas ou associe à une autre extension
+_EXTENSION_OVERRIDES = {
+    "image/jpg": ".jpg",   # Non standard mais envoyé par certains clients
+    "audio/ogg": ".ogg",   # Notes vocales WhatsApp (mimetypes donne ".oga")
+    "audio/wav": ".wav",
+}
+
+
+@lru_cache(maxsize=256)
+def get_extension_from_mime(mime_type: Optional[str]) -> str:
+    """
+    Détermine l'extension de fichier à partir du MIME type (résultat mis en cache)
+    
+    Args:
+        mime_type: Type MIME, éventuellement avec paramètres (ex: "audio/ogg; codecs=opus")
+        
+    Returns:
+        Extension avec le point (ex: ".jpg"), ".bin" si inconnue
+    """
+    # Type par défaut (en-tête absent) : inutile de consulter les tables
+    if mime_type is None or mime_type == "application/octet-stream":
+        return ".bin"
+    
+    mime_type = mime_type.split(";", 1)[0].strip().lower()
+    
+    extension = _EXTENSION_OVERRIDES.get(mime_type)
+    if extension is None:
+        extension = mimetypes.guess_extension(mime_type) or ".bin"
+    
+    return extension
+
+
+# Au-delà de ce nombre de fichiers, le nettoyage périodique n'examine qu'un
+# échantillon aléatoire à chaque passage
+CLEANUP_SAMPLE_THRESHOLD = 500
+CLEANUP_SAMPLE_SIZE = 128
+
 
 class MediaHandler:
     """Gère le téléchargement et le traitement des médias WhatsApp"""
@@ -36,18 +163,17 @@ class MediaHandler:
                 return None
             
             # Étape 2: Télécharger le fichier
-            file_path, mime_type = await self._download_file(media_url, media_id)
-            if not file_path:
+            downloaded = await self._download_file(media_url, media_id)
+            if not downloaded:
+                # L'URL signée a pu expirer : ne pas la resservir depuis le cache
+                _media_url_cache.pop(media_id, None)
                 logger.error(f"Échec du téléchargement depuis {media_url}")
                 return None
             
-            # Étape 3: Vérifier la taille
-            size_mb = estimate_file_size_mb(file_path)
-            if size_mb > Config.MAX_MEDIA_SIZE_MB:
-                logger.warning(f"Fichier trop volumineux: {size_mb}MB")
-                os.remove(file_path)
-                return None
+            file_path, mime_type = downloaded
             
+            # La taille maximale est déjà imposée pendant le téléchargement
+            size_mb = await estimate_file_size_mb(file_path)
             logger.info(f"Média téléchargé: {file_path} ({size_mb}MB)")
             return file_path, mime_type
             
@@ -57,7 +183,46 @@ class MediaHandler:
     
     async def _get_media_url(self, media_id: str) -> Optional[str]:
         """
-        Récupère l'URL de téléchargement du média
+        Récupère l'URL de téléchargement du média (avec cache TTL)
+        
+        Args:
+            media_id: ID du média
+            
+        Returns:
+            URL de téléchargement ou None
+        """
+        cached = _get_cached_media_url(media_id)
+        if cached:
+            return cached
+        
+        lock = _media_url_locks.get(media_id)
+        if lock is None:
+            lock = _media_url_locks[media_id] = asyncio.Lock()
+        _media_url_lock_users[media_id] = _media_url_lock_users.get(media_id, 0) + 1
+        
+        try:
+            async with lock:
+                # Un appel concurrent a peut-être déjà récupéré l'URL
+                cached = _get_cached_media_url(media_id)
+                if cached:
+                    return cached
+                
+                media_url = await self._fetch_media_url(media_id)
+                if media_url:
+                    _cache_media_url(media_id, media_url)
+                return media_url
+        finally:
+            users = _media_url_lock_users[media_id] - 1
+            if users:
+                _media_url_lock_users[media_id] = users
+            else:
+                del _media_url_lock_users[media_id]
+                if _media_url_locks.get(media_id) is lock and not lock.locked():
+                    del _media_url_locks[media_id]
+    
+    async def _fetch_media_url(self, media_id: str) -> Optional[str]:
+        """
+        Interroge l'API Graph pour obtenir l'URL de téléchargement du média
         
         Args:
             media_id: ID du média
@@ -66,21 +231,19 @@ class MediaHandler:
             URL de téléchargement ou None
         """
         url = f"https://graph.facebook.com/{Config.API_VERSION}/{media_id}"
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
         
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                response = await client.get(url, headers=headers)
+            client = _get_client()
+            async with _media_semaphore:
+                response = await request_with_retry(client, "GET", url, timeout=30)
+            
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                return data.get("url")
+            else:
+                logger.error(f"Erreur API Meta: {response.status_code} - {response.text[:512]}")
+                return None
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    return data.get("url")
-                else:
-                    logger.error(f"Erreur API Meta: {response.status_code} - {response.text}")
-                    return None
-                    
         except Exception as e:
             logger.error(f"Erreur lors de la récupération de l'URL: {e}")
             return None
@@ -100,98 +263,148 @@ class MediaHandler:
         Returns:
             Tuple (chemin_fichier, mime_type) ou None
         """
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
+        file_path = None
         
         try:
-            async with httpx.AsyncClient(timeout=60) as client:
-                response = await client.get(url, headers=headers)
-                
+            client = _get_client()
+            
+            # Téléchargement en streaming : le fichier est écrit par blocs
+            # au lieu d'être chargé entièrement en mémoire
+            async with _media_semaphore, stream_with_retry(client, "GET", url) as response:
                 if response.status_code != 200:
                     logger.error(f"Échec téléchargement: {response.status_code}")
                     return None
                 
+                # Refuser d'emblée les fichiers annoncés trop volumineux
+                max_bytes = Config.MAX_MEDIA_SIZE_MB * 1024 * 1024
+                content_length = int(response.headers.get("content-length") or 0)
+                if content_length > max_bytes:
+                    logger.warning(
+                        f"Fichier trop volumineux: {content_length / (1024 * 1024):.2f}MB"
+                    )
+                    return None
+                
                 # Déterminer le type MIME
                 mime_type = response.headers.get("content-type", "application/octet-stream")
                 
                 # Déterminer l'extension
-                extension = self._get_extension_from_mime(mime_type)
+                extension = get_extension_from_mime(mime_type)
                 
                 # Créer le nom de fichier
                 filename = sanitize_filename(f"{media_id}{extension}")
-                file_path = os.path.join(self.temp_dir, filename)
-                
-                # Écrire le fichier
-                with open(file_path, "wb") as f:
-                    f.write(response.content)
-                
-                return file_path, mime_type
+                target_path = os.path.join(self.temp_dir, filename)
                 
+                # Écrire le fichier bloc par bloc, en s'arrêtant dès que la
+                # taille maximale est dépassée (Content-Length peut être absent
+                # ou inexact)
+                written = 0
+                too_large = False
+                # Renseigné avant l'ouverture : le fichier partiel sera supprimé
+                # si le téléchargement échoue en cours de route
+                file_path = target_path
+                async with aiofiles.open(file_path, "wb") as f:
+                    async for chunk in response.aiter_bytes(chunk_size=64 * 1024):
+                        written += len(chunk)
+                        if written > max_bytes:
+                            too_large = True
+                            break
+                        await f.write(chunk)
+            
+            if too_large:
+                await asyncio.to_thread(os.remove, file_path)
+                logger.warning(
+                    f"Fichier trop volumineux: plus de {Config.MAX_MEDIA_SIZE_MB}MB, "
+                    "téléchargement interrompu"
+                )
+                return None
+            
+            return file_path, mime_type
+            
         except Exception as e:
             logger.error(f"Erreur lors du téléchargement du fichier: {e}")
+            
+            # Ne pas laisser de fichier tronqué jusqu'au nettoyage périodique
+            if file_path is not None:
+                try:
+                    await asyncio.to_thread(os.remove, file_path)
+                except FileNotFoundError:
+                    pass
+                except Exception as remove_error:
+                    logger.warning(f"Impossible de supprimer {file_path}: {remove_error}")
+            
             return None
     
-    def _get_extension_from_mime(self, mime_type: str) -> str:
+    async def cleanup_media(self, file_path: str) -> None:
         """
-        Détermine l'extension de fichier à partir du MIME type
-        
-        Args:
-            mime_type: Type MIME
-            
-        Returns:
-            Extension avec le point (ex: ".jpg")
-        """
-        mime_map = {
-            "image/jpeg": ".jpg",
-            "image/jpg": ".jpg",
-            "image/png": ".png",
-            "image/gif": ".gif",
-            "image/webp": ".webp",
-            "video/mp4": ".mp4",
-            "video/mpeg": ".mpeg",
-            "video/quicktime": ".mov",
-            "audio/mpeg": ".mp3",
-            "audio/ogg": ".ogg",
-            "audio/wav": ".wav",
-            "audio/aac": ".aac",
-            "application/pdf": ".pdf",
-        }
-        return mime_map.get(mime_type.lower(), ".bin")
-    
-    def cleanup_media(self, file_path: str) -> None:
-        """
-        Supprime un fichier média après traitement
+        Supprime un fichier média après traitement (dans un thread)
         
         Args:
             file_path: Chemin du fichier à supprimer
         """
         try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                logger.info(f"Fichier nettoyé: {file_path}")
+            await asyncio.to_thread(os.remove, file_path)
+            logger.info(f"Fichier nettoyé: {file_path}")
+        except FileNotFoundError:
+            pass
         except Exception as e:
             logger.warning(f"Impossible de supprimer {file_path}: {e}")
     
-    def cleanup_old_files(self, max_age_hours: int = 24) -> None:
+    async def cleanup_old_files(self, max_age_hours: int = 24, sample: bool = False) -> None:
         """
-        Supprime les fichiers temporaires anciens
+        Supprime les fichiers temporaires anciens (dans un thread, sans
+        bloquer la boucle d'événements)
         
         Args:
             max_age_hours: Age maximum en heures
+            sample: Pour un dossier volumineux, n'examiner qu'un échantillon
+                aléatoire de fichiers (balayage approximatif, amorti sur les
+                passages périodiques)
+        """
+        await asyncio.to_thread(self._cleanup_old_files_sync, max_age_hours, sample)
+    
+    def _cleanup_old_files_sync(self, max_age_hours: int, sample: bool) -> None:
+        """
+        Supprime les fichiers temporaires anciens (méthode synchrone)
+        
+        Args:
+            max_age_hours: Age maximum en heures
+            sample: Échantillonner les fichiers examinés si le dossier est volumineux
         """
         try:
-            import time
             now = time.time()
             cutoff = now - (max_age_hours * 3600)
             
-            for filename in os.listdir(self.temp_dir):
-                file_path = os.path.join(self.temp_dir, filename)
-                if os.path.isfile(file_path):
-                    file_mtime = os.path.getmtime(file_path)
-                    if file_mtime < cutoff:
-                        os.remove(file_path)
-                        logger.info(f"Ancien fichier supprimé: {filename}")
+            # scandir : type de fichier connu sans stat supplémentaire
+            with os.scandir(self.temp_dir) as it:
+                entries = [entry for entry in it if entry.is_file()]
+            
+            if sample and len(entries) > CLEANUP_SAMPLE_THRESHOLD:
+                entries = random.sample(entries, CLEANUP_SAMPLE_SIZE)
+            
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        logger.info(f"Ancien fichier supprimé: {entry.name}")
+                except FileNotFoundError:
+                    # Déjà supprimé entre-temps (cleanup_media)
+                    pass
                         
         except Exception as e:
-            logger.warning(f"Erreur lors du nettoyage: {e}")
\ No newline at end of file
+            logger.warning(f"Erreur lors du nettoyage: {e}")
+    
+    async def run_periodic_cleanup(
+        self,
+        interval_hours: float = 1,
+        max_age_hours: int = 24
+    ) -> None:
+        """
+        Nettoie périodiquement le dossier temporaire (à lancer en tâche de fond)
+        
+        Args:
+            interval_hours: Intervalle entre deux passages, en heures
+            max_age_hours: Age maximum des fichiers en heures
+        """
+        while True:
+            await asyncio.sleep(interval_hours * 3600)
+            await self.cleanup_old_files(max_age_hours=max_age_hours, sample=True)
\ No newline at end of file
@@ -2,24 +2,45 @@
 Processeur principal des messages WhatsApp
 Route les messages vers les détecteurs appropriés
 """
+import asyncio
 from typing import Dict, Optional
 from app.config import Config
 from app.sender import send_text_message
 from app.media_handler import MediaHandler
 from app.fake_news_detector import FakeNewsDetector
 from app.deepfake_detector import DeepfakeDetector
-from app.utils import setup_logger, format_analysis_result, get_media_type_from_mime
+from app.utils import (
+    setup_logger,
+    format_analysis_result,
+    get_media_type_from_mime,
+    run_in_background,
+)
 
 logger = setup_logger(__name__)
 
+# Détecteurs partagés par processus (les modèles ne sont chargés qu'une fois),
+# construits par warmup() au démarrage ou au premier message
+_fake_news_detector: Optional[FakeNewsDetector] = None
+_deepfake_detector: Optional[DeepfakeDetector] = None
+_processor: Optional["MessageProcessor"] = None
+
+# Commandes spéciales : mot-clé -> attribut de Config contenant la réponse
+_COMMANDS = {kw: "WELCOME_MESSAGE" for kw in ("start", "hello", "bonjour", "salut", "hi")}
+_COMMANDS.update({kw: "HELP_MESSAGE" for kw in ("help", "aide", "?")})
+_COMMANDS.update({kw: "INFO_MESSAGE" for kw in ("info", "about", "à propos")})
+
 
 class MessageProcessor:
     """Processeur principal des messages entrants"""
     
-    def __init__(self):
+    def __init__(
+        self,
+        fake_news_detector: Optional[FakeNewsDetector] = None,
+        deepfake_detector: Optional[DeepfakeDetector] = None
+    ):
         self.media_handler = MediaHandler()
-        self.fake_news_detector = FakeNewsDetector()
-        self.deepfake_detector = DeepfakeDetector()
+        self.fake_news_detector = fake_news_detector or FakeNewsDetector()
+        self.deepfake_detector = deepfake_detector or DeepfakeDetector()
         logger.info("MessageProcessor initialisé")
     
     async def process_incoming_message(self, message_data: Dict) -> None:
@@ -75,38 +96,32 @@ class MessageProcessor:
             return
         
         # Commandes spéciales
-        text_lower = text_body.lower()
-        
-        if text_lower in ["start", "hello", "bonjour", "salut", "hi"]:
-            await send_text_message(from_number, Config.WELCOME_MESSAGE)
+        msg_attr = _COMMANDS.get(text_body.lower())
+        if msg_attr:
+            await send_text_message(from_number, getattr(Config, msg_attr))
             return
         
-        elif text_lower in ["help", "aide", "?"]:
-            await send_text_message(from_number, Config.HELP_MESSAGE)
-            return
-        
-        elif text_lower in ["info", "about", "à propos"]:
-            await send_text_message(from_number, Config.INFO_MESSAGE)
-            return
-        
-        # Analyser le texte pour les fake news
-        await send_text_message(
+        # Analyser le texte pour les fake news (l'accusé "en cours" part en
+        # parallèle de l'analyse)
+        notify_task = asyncio.create_task(send_text_message(
             from_number,
             "🔍 Analyse en cours...\n\nCela peut prendre quelques secondes."
-        )
+        ))
         
         try:
             # Analyse fake news
             analysis = await self.fake_news_detector.analyze_text(text_body)
             
-            # Formater et envoyer le résultat
+            # Formater et envoyer le résultat (après l'accusé, pour l'ordre)
             result_message = self.fake_news_detector.get_analysis_summary(analysis)
+            await notify_task
             await send_text_message(from_number, result_message)
             
             logger.info(f"Analyse texte terminée pour {from_number}: fake={analysis['is_fake']}")
             
         except Exception as e:
             logger.error(f"Erreur analyse texte: {e}")
+            await notify_task
             await send_text_message(
                 from_number,
                 "❌ Erreur lors de l'analyse du texte. Veuillez réessayer."
@@ -139,17 +154,17 @@ class MessageProcessor:
                 )
                 return
             
-            # Informer l'utilisateur
-            await send_text_message(
-                from_number,
-                f"📥 Téléchargement du média en cours...\n\n"
-                f"Type: {media_type}\n"
-                f"Cela peut prendre jusqu'à 30 secondes."
+            # Informer l'utilisateur et télécharger le média en parallèle
+            _, result = await asyncio.gather(
+                send_text_message(
+                    from_number,
+                    f"📥 Téléchargement du média en cours...\n\n"
+                    f"Type: {media_type}\n"
+                    f"Cela peut prendre jusqu'à 30 secondes."
+                ),
+                self.media_handler.download_media(media_id)
             )
             
-            # Télécharger le média
-            result = await self.media_handler.download_media(media_id)
-            
             if not result:
                 await send_text_message(
                     from_number,
@@ -160,16 +175,16 @@ class MessageProcessor:
             
             file_path, mime_type = result
             
-            # Informer que l'analyse commence
-            await send_text_message(
-                from_number,
-                "🔍 Analyse en cours...\n\n"
-                "Détection de deepfakes et manipulations."
+            # Informer que l'analyse commence et analyser le média en parallèle
+            _, analysis = await asyncio.gather(
+                send_text_message(
+                    from_number,
+                    "🔍 Analyse en cours...\n\n"
+                    "Détection de deepfakes et manipulations."
+                ),
+                self.deepfake_detector.analyze_media(file_path, mime_type)
             )
             
-            # Analyser le média
-            analysis = await self.deepfake_detector.analyze_media(file_path, mime_type)
-            
             # Formater le résultat
             content_type = get_media_type_from_mime(mime_type)
             result_message = format_analysis_result(
@@ -187,8 +202,8 @@ class MessageProcessor:
                 f"type={content_type}, fake={analysis['is_fake']}"
             )
             
-            # Nettoyer le fichier temporaire
-            self.media_handler.cleanup_media(file_path)
+            # Nettoyer le fichier temporaire (en tâche de fond)
+            run_in_background(self.media_handler.cleanup_media(file_path))
             
         except Exception as e:
             logger.error(f"Erreur traitement média: {e}", exc_info=True)
@@ -209,4 +224,45 @@ class MessageProcessor:
             await send_text_message(phone_number, Config.WELCOME_MESSAGE)
             logger.info(f"Message de bienvenue envoyé à {phone_number}")
         except Exception as e:
-            logger.error(f"Erreur envoi bienvenue: {e}")
\ No newline at end of file
+            logger.error(f"Erreur envoi bienvenue: {e}")
+
+
+def get_processor() -> MessageProcessor:
+    """
+    Retourne le processeur de messages partagé, en le créant si besoin
+    
+    Returns:
+        MessageProcessor utilisant les détecteurs partagés
+    """
+    global _fake_news_detector, _deepfake_detector, _processor
+    
+    if _processor is None:
+        if _fake_news_detector is None:
+            _fake_news_detector = FakeNewsDetector()
+        if _deepfake_detector is None:
+            _deepfake_detector = DeepfakeDetector()
+        _processor = MessageProcessor(_fake_news_detector, _deepfake_detector)
+    
+    return _processor
+
+
+async def warmup() -> None:
+    """
+    Construit les détecteurs partagés et charge leurs modèles dans des
+    threads, pour que le premier message ne paie pas le chargement
+    """
+    processor = get_processor()
+    
+    results = await asyncio.gather(
+        asyncio.to_thread(processor.fake_news_detector.warm_up),
+        asyncio.to_thread(processor.deepfake_detector.warm_up),
+        return_exceptions=True
+    )
+    
+    errors = [result for result in results if isinstance(result, Exception)]
+    for error in errors:
+        # Le modèle sera rechargé au premier message
+        logger.warning(f"⚠️ Préchargement des modèles incomplet: {error}")
+    
+    if not errors:
+        logger.info("✅ Modèles préchargés")
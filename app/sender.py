@@ -1,14 +1,81 @@
 """
 Service d'envoi de messages WhatsApp via l'API Meta Cloud
 """
+import asyncio
+import logging
 import httpx
+import orjson
+from typing import Optional
 from app.config import Config
-from app.utils import setup_logger
+from app.utils import setup_logger, request_with_retry
 
 logger = setup_logger(__name__)
 
+__all__ = [
+    "send_text_message",
+    "send_image_message",
+    "send_template_message",
+    "mark_message_as_read",
+    "close_client",
+]
+
 BASE_URL = "https://graph.facebook.com"
 
+# Chemin de l'endpoint d'envoi, calculé une seule fois (configuration immuable)
+_MESSAGES_PATH = f"/{Config.API_VERSION}/{Config.PHONE_NUMBER_ID}/messages"
+
+# La configuration n'est validée qu'au premier envoi
+_config_validated = False
+
+# Limite des appels simultanés à l'API Meta (lisse les rafales, limite de débit)
+_send_semaphore = asyncio.Semaphore(20)
+
+# Client HTTP partagé (pool de connexions keep-alive + HTTP/2), créé au premier
+# envoi et fermé à l'arrêt de l'application
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _ensure_config() -> None:
+    """Valide la configuration une seule fois (lève RuntimeError si incomplète)"""
+    global _config_validated
+    
+    if not _config_validated:
+        Config.validate()
+        _config_validated = True
+
+
+def _get_client() -> httpx.AsyncClient:
+    """
+    Retourne le client HTTP partagé vers l'API Graph, en le créant si besoin
+    
+    Returns:
+        Client httpx réutilisé entre les appels
+    """
+    global _client
+    
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=BASE_URL,
+            http2=True,
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+            headers={
+                "Authorization": f"Bearer {Config.WHATSAPP_TOKEN}",
+                "Content-Type": "application/json"
+            }
+        )
+    
+    return _client
+
+
+async def close_client() -> None:
+    """Ferme le client HTTP partagé (à appeler à l'arrêt de l'application)"""
+    global _client
+    
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
 
 async def send_text_message(to_number: str, message: str) -> bool:
     """
@@ -22,13 +89,7 @@ async def send_text_message(to_number: str, message: str) -> bool:
         True si succès, False sinon
     """
     try:
-        Config.validate()
-        
-        url = f"{BASE_URL}/{Config.API_VERSION}/{Config.PHONE_NUMBER_ID}/messages"
-        headers = {
-            "Authorization": f"Bearer {Config.WHATSAPP_TOKEN}",
-            "Content-Type": "application/json"
-        }
+        _ensure_config()
         
         payload = {
             "messaging_product": "whatsapp",
@@ -41,23 +102,29 @@ async def send_text_message(to_number: str, message: str) -> bool:
             }
         }
         
-        logger.info(f"📤 Envoi message à {to_number}: {message[:50]}...")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f"📤 Envoi message à {to_number}: {message[:50]}...")
         
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.post(url, headers=headers, json=payload)
+        client = _get_client()
+        async with _send_semaphore:
+            response = await request_with_retry(
+                client, "POST", _MESSAGES_PATH,
+                content=orjson.dumps(payload),
+                idempotent=False  # Pas de rejeu : le message a pu être envoyé
+            )
+        
+        if response.status_code == 200:
+            data = orjson.loads(response.content)
+            message_id = data.get("messages", [{}])[0].get("id", "unknown")
+            logger.info(f"✅ Message envoyé avec succès: ID={message_id}")
+            return True
+        else:
+            logger.error(
+                f"❌ Échec envoi message: {response.status_code}\n"
+                f"Réponse: {response.text[:512]}"
+            )
+            return False
             
-            if response.status_code == 200:
-                data = response.json()
-                message_id = data.get("messages", [{}])[0].get("id", "unknown")
-                logger.info(f"✅ Message envoyé avec succès: ID={message_id}")
-                return True
-            else:
-                logger.error(
-                    f"❌ Échec envoi message: {response.status_code}\n"
-                    f"Réponse: {response.text}"
-                )
-                return False
-                
     except Exception as e:
         logger.error(f"❌ Erreur lors de l'envoi du message: {e}", exc_info=True)
         return False
@@ -80,13 +147,7 @@ async def send_image_message(
         True si succès, False sinon
     """
     try:
-        Config.validate()
-        
-        url = f"{BASE_URL}/{Config.API_VERSION}/{Config.PHONE_NUMBER_ID}/messages"
-        headers = {
-            "Authorization": f"Bearer {Config.WHATSAPP_TOKEN}",
-            "Content-Type": "application/json"
-        }
+        _ensure_config()
         
         payload = {
             "messaging_product": "whatsapp",
@@ -103,16 +164,21 @@ async def send_image_message(
         
         logger.info(f"📤 Envoi image à {to_number}")
         
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.post(url, headers=headers, json=payload)
+        client = _get_client()
+        async with _send_semaphore:
+            response = await request_with_retry(
+                client, "POST", _MESSAGES_PATH,
+                content=orjson.dumps(payload),
+                idempotent=False  # Pas de rejeu : le message a pu être envoyé
+            )
+        
+        if response.status_code == 200:
+            logger.info("✅ Image envoyée avec succès")
+            return True
+        else:
+            logger.error(f"❌ Échec envoi image: {response.status_code}")
+            return False
             
-            if response.status_code == 200:
-                logger.info("✅ Image envoyée avec succès")
-                return True
-            else:
-                logger.error(f"❌ Échec envoi image: {response.status_code}")
-                return False
-                
     except Exception as e:
         logger.error(f"❌ Erreur envoi image: {e}")
         return False
@@ -135,13 +201,7 @@ async def send_template_message(
         True si succès, False sinon
     """
     try:
-        Config.validate()
-        
-        url = f"{BASE_URL}/{Config.API_VERSION}/{Config.PHONE_NUMBER_ID}/messages"
-        headers = {
-            "Authorization": f"Bearer {Config.WHATSAPP_TOKEN}",
-            "Content-Type": "application/json"
-        }
+        _ensure_config()
         
         payload = {
             "messaging_product": "whatsapp",
@@ -157,16 +217,21 @@ async def send_template_message(
         
         logger.info(f"📤 Envoi template '{template_name}' à {to_number}")
         
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.post(url, headers=headers, json=payload)
+        client = _get_client()
+        async with _send_semaphore:
+            response = await request_with_retry(
+                client, "POST", _MESSAGES_PATH,
+                content=orjson.dumps(payload),
+                idempotent=False  # Pas de rejeu : le message a pu être envoyé
+            )
+        
+        if response.status_code == 200:
+            logger.info("✅ Template envoyé avec succès")
+            return True
+        else:
+            logger.error(f"❌ Échec envoi template: {response.status_code}")
+            return False
             
-            if response.status_code == 200:
-                logger.info("✅ Template envoyé avec succès")
-                return True
-            else:
-                logger.error(f"❌ Échec envoi template: {response.status_code}")
-                return False
-                
     except Exception as e:
         logger.error(f"❌ Erreur envoi template: {e}")
         return False
@@ -183,13 +248,7 @@ async def mark_message_as_read(message_id: str) -> bool:
         True si succès, False sinon
     """
     try:
-        Config.validate()
-        
-        url = f"{BASE_URL}/{Config.API_VERSION}/{Config.PHONE_NUMBER_ID}/messages"
-        headers = {
-            "Authorization": f"Bearer {Config.WHATSAPP_TOKEN}",
-            "Content-Type": "application/json"
-        }
+        _ensure_config()
         
         payload = {
             "messaging_product": "whatsapp",
@@ -197,16 +256,20 @@ async def mark_message_as_read(message_id: str) -> bool:
             "message_id": message_id
         }
         
-        async with httpx.AsyncClient(timeout=10) as client:
-            response = await client.post(url, headers=headers, json=payload)
+        # Marquer comme lu est idempotent : nouvelles tentatives sans restriction
+        client = _get_client()
+        async with _send_semaphore:
+            response = await request_with_retry(
+                client, "POST", _MESSAGES_PATH, content=orjson.dumps(payload), timeout=10
+            )
+        
+        if response.status_code == 200:
+            logger.debug(f"Message {message_id} marqué comme lu")
+            return True
+        else:
+            logger.warning(f"Échec marquage lu: {response.status_code}")
+            return False
             
-            if response.status_code == 200:
-                logger.debug(f"Message {message_id} marqué comme lu")
-                return True
-            else:
-                logger.warning(f"Échec marquage lu: {response.status_code}")
-                return False
-                
     except Exception as e:
         logger.warning(f"Erreur marquage lu: {e}")
         return False
\ No newline at end of file
@@ -1,15 +1,26 @@
 """
 Fonctions utilitaires pour le bot
 """
+import asyncio
 import logging
 import os
+import random
+import re
 import sys
+from contextlib import asynccontextmanager
 from datetime import datetime
+from functools import lru_cache
+from typing import AsyncIterator, Coroutine, Optional, Set
 
+import httpx
 
+from app.config import Config
+
+
+@lru_cache(maxsize=None)
 def setup_logger(name: str = __name__) -> logging.Logger:
     """
-    Configure et retourne un logger
+    Configure et retourne un logger (mémoïsé par nom)
     
     Args:
         name: Nom du logger
@@ -25,10 +36,7 @@ def setup_logger(name: str = __name__) -> logging.Logger:
     logger.setLevel(logging.INFO)
     
     # Format
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
+    formatter = _build_formatter()
     
     # Console handler
     console_handler = logging.StreamHandler(sys.stdout)
@@ -38,6 +46,95 @@ def setup_logger(name: str = __name__) -> logging.Logger:
     return logger
 
 
+def _build_formatter() -> logging.Formatter:
+    """
+    Construit le formateur des logs : JSON si Config.LOG_JSON (et
+    python-json-logger installé), texte sinon
+    
+    Returns:
+        Formateur à attacher aux handlers
+    """
+    if Config.LOG_JSON:
+        try:
+            from pythonjsonlogger.jsonlogger import JsonFormatter
+            
+            return JsonFormatter(
+                '%(asctime)s %(name)s %(levelname)s %(message)s',
+                datefmt='%Y-%m-%d %H:%M:%S',
+                json_ensure_ascii=False
+            )
+        except ImportError:
+            # Dépendance optionnelle absente : repli sur le format texte
+            pass
+    
+    return logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+
+logger = setup_logger(__name__)
+
+# Réponses HTTP transitoires justifiant une nouvelle tentative
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+# Pour une requête non idempotente (envoi de message), seuls ces cas garantissent
+# que l'API n'a pas traité la requête : limite de débit, ou échec avant envoi
+NON_IDEMPOTENT_RETRYABLE_STATUS_CODES = frozenset({429})
+NON_IDEMPOTENT_RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# Attente maximale acceptée pour un en-tête Retry-After (secondes)
+MAX_RETRY_AFTER_SECONDS = 30.0
+
+# Emojis de confiance par tranche de 0.2 : [0, 0.4[ ❌, [0.4, 0.6[ ⚡, [0.6, 0.8[ ⚠️, >= 0.8 ✅
+_CONFIDENCE_EMOJIS = ("❌", "❌", "⚡", "⚠️", "✅")
+
+# Gabarit des résultats d'analyse ; les champs doublés ({{...}}) sont
+# remplis à chaque appel, les autres une fois pour toutes ci-dessous
+_RESULT_TEMPLATE = """{emoji} **RÉSULTAT D'ANALYSE**
+
+📊 **Type :** {{content_type}}
+🎯 **Verdict :** {verdict}
+📈 **Confiance :** {{confidence_emoji}} {{confidence_str}}
+
+{recommendation}{{details_block}}
+
+━━━━━━━━━━━━━━━━━━━━━
+⚠️ Cette analyse automatique n'est pas infaillible.
+Utilisez toujours votre jugement critique !"""
+
+_RESULT_FAKE = _RESULT_TEMPLATE.format(
+    emoji="🚨",
+    verdict="CONTENU SUSPECT",
+    recommendation=(
+        "⚠️ Ce contenu présente des signes de manipulation ou de désinformation.\n\n"
+        "**Recommandations :**\n"
+        "• Vérifiez les sources originales\n"
+        "• Consultez des fact-checkers reconnus\n"
+        "• Soyez prudent avant de partager"
+    )
+)
+
+_RESULT_OK = _RESULT_TEMPLATE.format(
+    emoji="✅",
+    verdict="CONTENU PROBABLEMENT AUTHENTIQUE",
+    recommendation=(
+        "✅ Ce contenu semble authentique selon notre analyse.\n\n"
+        "**Rappel :**\n"
+        "• Restez vigilant même pour du contenu authentique\n"
+        "• Le contexte peut changer la signification\n"
+        "• Vérifiez toujours les sources importantes"
+    )
+)
+
+# Caractères interdits dans les noms de fichiers (tout sauf [A-Za-z0-9._-])
+_UNSAFE_FILENAME_CHARS = re.compile(r"[^A-Za-z0-9._-]")
+
+# Références fortes vers les tâches de fond : la boucle d'événements ne garde
+# que des références faibles, une tâche non référencée peut être collectée
+_background_tasks: Set[asyncio.Task] = set()
+
+
 def format_confidence(score: float) -> str:
     """
     Formate un score de confiance en pourcentage
@@ -61,14 +158,9 @@ def get_confidence_emoji(score: float) -> str:
     Returns:
         Emoji approprié
     """
-    if score >= 0.8:
-        return "✅"
-    elif score >= 0.6:
-        return "⚠️"
-    elif score >= 0.4:
-        return "⚡"
-    else:
-        return "❌"
+    # Seuils 0.4 / 0.6 / 0.8 : une tranche de 0.2 par entrée du tuple
+    index = min(max(int(score * 10) // 2, 0), len(_CONFIDENCE_EMOJIS) - 1)
+    return _CONFIDENCE_EMOJIS[index]
 
 
 def format_analysis_result(
@@ -89,50 +181,14 @@ def format_analysis_result(
     Returns:
         Message formaté
     """
-    emoji = "🚨" if is_fake else "✅"
-    confidence_str = format_confidence(confidence)
-    confidence_emoji = get_confidence_emoji(confidence)
-    
-    # Verdict
-    if is_fake:
-        verdict = "CONTENU SUSPECT"
-        recommendation = (
-            "⚠️ Ce contenu présente des signes de manipulation ou de désinformation.\n\n"
-            "**Recommandations :**\n"
-            "• Vérifiez les sources originales\n"
-            "• Consultez des fact-checkers reconnus\n"
-            "• Soyez prudent avant de partager"
-        )
-    else:
-        verdict = "CONTENU PROBABLEMENT AUTHENTIQUE"
-        recommendation = (
-            "✅ Ce contenu semble authentique selon notre analyse.\n\n"
-            "**Rappel :**\n"
-            "• Restez vigilant même pour du contenu authentique\n"
-            "• Le contexte peut changer la signification\n"
-            "• Vérifiez toujours les sources importantes"
-        )
-    
-    # Construction du message
-    message = f"""{emoji} **RÉSULTAT D'ANALYSE**
-
-📊 **Type :** {content_type.title()}
-🎯 **Verdict :** {verdict}
-📈 **Confiance :** {confidence_emoji} {confidence_str}
-
-{recommendation}"""
-    
-    if details:
-        message += f"\n\n🔍 **Détails :**\n{details}"
+    details_block = f"\n\n🔍 **Détails :**\n{details}" if details else ""
     
-    message += (
-        "\n\n"
-        "━━━━━━━━━━━━━━━━━━━━━\n"
-        "⚠️ Cette analyse automatique n'est pas infaillible.\n"
-        "Utilisez toujours votre jugement critique !"
+    return (_RESULT_FAKE if is_fake else _RESULT_OK).format(
+        content_type=content_type.title(),
+        confidence_emoji=get_confidence_emoji(confidence),
+        confidence_str=format_confidence(confidence),
+        details_block=details_block
     )
-    
-    return message
 
 
 def sanitize_filename(filename: str) -> str:
@@ -146,8 +202,7 @@ def sanitize_filename(filename: str) -> str:
         Nom de fichier sécurisé
     """
     # Supprimer les caractères dangereux
-    safe_chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789._-"
-    filename = "".join(c for c in filename if c in safe_chars)
+    filename = _UNSAFE_FILENAME_CHARS.sub("", filename)
     
     # Limiter la longueur
     if len(filename) > 100:
@@ -185,9 +240,9 @@ def get_media_type_from_mime(mime_type: str) -> str:
         return "unknown"
 
 
-def estimate_file_size_mb(file_path: str) -> float:
+async def estimate_file_size_mb(file_path: str) -> float:
     """
-    Estime la taille d'un fichier en MB
+    Estime la taille d'un fichier en MB (stat exécuté dans un thread)
     
     Args:
         file_path: Chemin du fichier
@@ -196,8 +251,230 @@ def estimate_file_size_mb(file_path: str) -> float:
         Taille en MB
     """
     try:
-        size_bytes = os.path.getsize(file_path)
+        size_bytes = await asyncio.to_thread(os.path.getsize, file_path)
         size_mb = size_bytes / (1024 * 1024)
         return round(size_mb, 2)
     except:
-        return 0.0
\ No newline at end of file
+        return 0.0
+
+
+def share_model_weights(model, model_name: str):
+    """
+    Remplace les poids d'un modèle par ceux d'un fichier safetensors mappé
+    en mémoire, afin que les workers partagent les mêmes pages (page cache)
+    au lieu de garder chacun leur copie
+    
+    Args:
+        model: Modèle PyTorch chargé (from_pretrained)
+        model_name: Nom du modèle Hugging Face (sert de nom de fichier,
+            avec la révision résolue)
+        
+    Returns:
+        Le même modèle, dont les poids pointent vers le fichier mappé
+    """
+    try:
+        from safetensors import safe_open
+        from safetensors.torch import load_file, save_model
+        
+        # La révision (commit du Hub) fait partie du nom : un modèle mis à
+        # jour ou une autre révision ne réutilise jamais un fichier périmé
+        revision = getattr(model.config, "_commit_hash", None) or "local"
+        os.makedirs(Config.MODEL_CACHE_DIR, exist_ok=True)
+        filename = sanitize_filename(f"{model_name.replace('/', '--')}--{revision}") + ".safetensors"
+        path = os.path.join(Config.MODEL_CACHE_DIR, filename)
+        
+        # Premier worker : sérialiser les poids (écriture atomique)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            save_model(model, tmp_path)
+            os.replace(tmp_path, path)
+            logger.info(f"Poids du modèle sérialisés: {path}")
+        
+        # load_file mappe le fichier ; save_model a retiré les poids liés
+        # (tied weights), listés dans les métadonnées : les rétablir
+        state = load_file(path, device="cpu")
+        with safe_open(path, framework="pt") as f:
+            aliases = f.metadata() or {}
+        for removed, kept in aliases.items():
+            if kept in state:
+                state[removed] = state[kept]
+        
+        # Vérifier la correspondance avant de charger quoi que ce soit : un
+        # fichier incompatible est supprimé et le modèle garde ses poids
+        expected = model.state_dict()
+        missing = expected.keys() - state.keys()
+        unexpected = state.keys() - expected.keys()
+        mismatched = [
+            key for key in expected.keys() & state.keys()
+            if expected[key].shape != state[key].shape
+        ]
+        if missing or unexpected or mismatched:
+            os.remove(path)
+            logger.warning(
+                f"⚠️ Poids en cache incompatibles pour {model_name} "
+                f"(manquants: {sorted(missing)[:5]}, inattendus: {sorted(unexpected)[:5]}, "
+                f"formes: {mismatched[:5]}), fichier supprimé"
+            )
+            return model
+        
+        # assign=True (torch >= 2.1) garde les tenseurs mappés tels quels
+        model.load_state_dict(state, strict=True, assign=True)
+        
+    except Exception as e:
+        logger.warning(f"⚠️ Partage des poids impossible pour {model_name}: {e}")
+    
+    return model
+
+
+def run_in_background(coro: Coroutine) -> asyncio.Task:
+    """
+    Lance une coroutine en tâche de fond, sans attendre son résultat
+    
+    Args:
+        coro: Coroutine à exécuter
+        
+    Returns:
+        Tâche créée (référencée jusqu'à sa fin)
+    """
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def backoff_delay(
+    attempt: int,
+    retry_after: Optional[str] = None,
+    base: float = 0.25,
+    cap: float = 4.0
+) -> float:
+    """
+    Calcule l'attente avant une nouvelle tentative (backoff exponentiel,
+    "full jitter"), en respectant l'en-tête Retry-After s'il est fourni
+    
+    Args:
+        attempt: Numéro de la tentative échouée (0 pour la première)
+        retry_after: Valeur de l'en-tête Retry-After (secondes)
+        base: Attente de base en secondes
+        cap: Attente maximale en secondes (hors Retry-After)
+        
+    Returns:
+        Durée d'attente en secondes
+    """
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0.0), MAX_RETRY_AFTER_SECONDS)
+        except ValueError:
+            # Format date HTTP : on retombe sur le backoff
+            pass
+    
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def _send_with_retry(
+    client: httpx.AsyncClient,
+    method: str,
+    url: str,
+    attempts: int,
+    stream: bool,
+    idempotent: bool,
+    **kwargs
+) -> httpx.Response:
+    """
+    Envoie une requête en réessayant sur erreur réseau ou 429/5xx ; une
+    requête non idempotente n'est réessayée que sur 429 ou échec de connexion
+    """
+    if idempotent:
+        retryable_errors = httpx.TransportError
+        retryable_status_codes = RETRYABLE_STATUS_CODES
+    else:
+        retryable_errors = NON_IDEMPOTENT_RETRYABLE_ERRORS
+        retryable_status_codes = NON_IDEMPOTENT_RETRYABLE_STATUS_CODES
+    
+    for attempt in range(attempts):
+        is_last = attempt == attempts - 1
+        
+        try:
+            request = client.build_request(method, url, **kwargs)
+            response = await client.send(request, stream=stream)
+        except retryable_errors as e:
+            if is_last:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(f"⚠️ Erreur réseau ({e}), nouvelle tentative dans {delay:.2f}s")
+            await asyncio.sleep(delay)
+            continue
+        
+        if response.status_code in retryable_status_codes and not is_last:
+            delay = backoff_delay(attempt, response.headers.get("retry-after"))
+            await response.aclose()
+            logger.warning(
+                f"⚠️ Réponse {response.status_code}, nouvelle tentative dans {delay:.2f}s"
+            )
+            await asyncio.sleep(delay)
+            continue
+        
+        return response
+
+
+async def request_with_retry(
+    client: httpx.AsyncClient,
+    method: str,
+    url: str,
+    attempts: int = 4,
+    idempotent: bool = True,
+    **kwargs
+) -> httpx.Response:
+    """
+    Envoie une requête HTTP avec nouvelles tentatives sur les erreurs
+    transitoires (erreurs réseau, 429, 5xx)
+    
+    Args:
+        client: Client httpx
+        method: Méthode HTTP
+        url: URL (ou chemin relatif à la base_url du client)
+        attempts: Nombre maximal de tentatives
+        idempotent: False si la requête ne doit pas être rejouée après avoir
+            pu être traitée (envoi de message) : seuls 429 et les échecs de
+            connexion sont alors réessayés
+        **kwargs: Arguments passés à client.build_request (json, timeout...)
+        
+    Returns:
+        Dernière réponse reçue (le statut reste à vérifier par l'appelant)
+    """
+    return await _send_with_retry(
+        client, method, url, attempts, False, idempotent, **kwargs
+    )
+
+
+@asynccontextmanager
+async def stream_with_retry(
+    client: httpx.AsyncClient,
+    method: str,
+    url: str,
+    attempts: int = 4,
+    idempotent: bool = True,
+    **kwargs
+) -> AsyncIterator[httpx.Response]:
+    """
+    Variante en streaming de request_with_retry : le corps de la réponse
+    n'est pas lu, la réponse est fermée en sortie du bloc
+    
+    Args:
+        client: Client httpx
+        method: Méthode HTTP
+        url: URL
+        attempts: Nombre maximal de tentatives
+        idempotent: Voir request_with_retry
+        **kwargs: Arguments passés à client.build_request
+        
+    Yields:
+        Réponse en streaming
+    """
+    response = await _send_with_retry(
+        client, method, url, attempts, True, idempotent, **kwargs
+    )
+    try:
+        yield response
+    finally:
+        await response.aclose()
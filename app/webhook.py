@@ -1,15 +1,202 @@
 """
 Gestionnaires de webhooks Meta pour WhatsApp
 """
+import asyncio
+import hmac
+import logging
+import msgspec
+from typing import Any, List, Optional
 from fastapi import Request, Response
+from fastapi.responses import PlainTextResponse
 from app.config import Config
-from app.message_processor import MessageProcessor
+from app.message_processor import get_processor
 from app.utils import setup_logger
 
 logger = setup_logger(__name__)
 
-# Instance globale du processeur de messages
-message_processor = MessageProcessor()
+# Les webhooks étant acquittés avant traitement, une rafale ne doit pas lancer
+# un nombre illimité d'analyses en parallèle (les statuts restent non bornés)
+_message_semaphore = asyncio.Semaphore(max(1, Config.MAX_CONCURRENT_MESSAGES))
+
+# Types de message dont le contenu est recopié tel quel (champ du même nom)
+_TYPED_FIELDS = frozenset({
+    "text",
+    "image",
+    "video",
+    "audio",
+    "document",
+    "interactive",  # Réponses aux boutons interactifs
+    "button",       # Ancienne façon de gérer les boutons
+})
+
+
+# Structure du webhook Meta, décodée directement depuis le JSON (les champs
+# inconnus sont ignorés, tous les champs sont optionnels ; seuls les champs
+# utilisés pour le routage sont typés, les autres acceptent n'importe quel
+# type JSON comme l'accès par dict d'origine) :
+# {
+#   "object": "whatsapp_business_account",
+#   "entry": [{
+#     "id": "...",
+#     "changes": [{
+#       "value": {
+#         "messaging_product": "whatsapp",
+#         "metadata": {...},
+#         "contacts": [...],
+#         "messages": [...]
+#       },
+#       "field": "messages"
+#     }]
+#   }]
+# }
+
+class Profile(msgspec.Struct):
+    """Profil WhatsApp d'un contact"""
+    name: Any = None
+
+
+class Contact(msgspec.Struct):
+    """Contact à l'origine des messages"""
+    wa_id: Any = None
+    profile: Optional[Profile] = None
+
+
+class Message(msgspec.Struct):
+    """Message entrant ; le contenu reste un dict, tel qu'attendu par le processeur"""
+    id: Optional[str] = None
+    from_: Optional[str] = msgspec.field(default=None, name="from")
+    timestamp: Any = None
+    type: Optional[str] = None
+    text: Optional[dict] = None
+    image: Optional[dict] = None
+    video: Optional[dict] = None
+    audio: Optional[dict] = None
+    document: Optional[dict] = None
+    interactive: Optional[dict] = None
+    button: Optional[dict] = None
+
+
+class Status(msgspec.Struct):
+    """Mise à jour de statut d'un message envoyé"""
+    id: Optional[str] = None
+    status: Optional[str] = None
+    recipient_id: Any = None
+    errors: Any = None
+
+
+class Value(msgspec.Struct):
+    """Contenu d'un changement (messages, statuts, contacts)"""
+    contacts: List[Contact] = []
+    messages: List[Message] = []
+    statuses: List[Status] = []
+
+
+class Change(msgspec.Struct):
+    """Changement notifié pour un compte"""
+    field: Any = None
+    value: Optional[Value] = None
+
+
+class Entry(msgspec.Struct):
+    """Entrée du webhook (un compte WhatsApp Business)"""
+    id: Any = None
+    changes: List[Change] = []
+
+
+class WebhookPayload(msgspec.Struct):
+    """Payload complet envoyé par Meta"""
+    object: Any = None
+    entry: List[Entry] = []
+
+
+_payload_decoder = msgspec.json.Decoder(WebhookPayload)
+
+# Clé HMAC de signature des webhooks, encodée une fois (None : pas de vérification)
+_app_secret = Config.APP_SECRET.encode() if Config.APP_SECRET else None
+
+
+def decode_payload(body: bytes) -> WebhookPayload:
+    """
+    Décode le corps JSON d'un webhook en structures typées
+    
+    Args:
+        body: Corps brut de la requête
+        
+    Returns:
+        Payload décodé (lève msgspec.DecodeError si le JSON est invalide)
+    """
+    try:
+        return _payload_decoder.decode(body)
+    except msgspec.ValidationError as e:
+        # Un champ inattendu ne doit pas faire perdre tout le lot (Meta ne
+        # renverra pas le webhook) : décodage élément par élément
+        logger.warning(f"⚠️ Webhook non conforme ({e}), décodage par élément")
+        return _decode_payload_lenient(body)
+
+
+def _as_list(value: Any) -> list:
+    """Retourne la valeur si c'est une liste, une liste vide sinon"""
+    return value if isinstance(value, list) else []
+
+
+def _convert_items(items: Any, struct_type: type) -> list:
+    """
+    Convertit chaque élément d'une liste JSON, en ignorant ceux qui ne
+    correspondent pas à la structure attendue
+    
+    Args:
+        items: Liste brute (dicts)
+        struct_type: Structure msgspec cible
+        
+    Returns:
+        Liste des éléments convertis
+    """
+    converted = []
+    for item in _as_list(items):
+        try:
+            converted.append(msgspec.convert(item, struct_type))
+        except msgspec.ValidationError as e:
+            logger.warning(f"⚠️ {struct_type.__name__} ignoré: {e}")
+    return converted
+
+
+def _decode_payload_lenient(body: bytes) -> WebhookPayload:
+    """
+    Décode un webhook non conforme : seuls les messages, statuts et contacts
+    invalides sont écartés, les autres sont traités normalement
+    
+    Args:
+        body: Corps brut de la requête
+        
+    Returns:
+        Payload reconstruit
+    """
+    raw = msgspec.json.decode(body)
+    raw_entries = raw.get("entry") if isinstance(raw, dict) else None
+    
+    entries = []
+    for raw_entry in _as_list(raw_entries):
+        if not isinstance(raw_entry, dict):
+            continue
+        
+        changes = []
+        for raw_change in _as_list(raw_entry.get("changes")):
+            if not isinstance(raw_change, dict):
+                continue
+            
+            raw_value = raw_change.get("value")
+            value = None
+            if isinstance(raw_value, dict):
+                value = Value(
+                    contacts=_convert_items(raw_value.get("contacts"), Contact),
+                    messages=_convert_items(raw_value.get("messages"), Message),
+                    statuses=_convert_items(raw_value.get("statuses"), Status)
+                )
+            changes.append(Change(field=raw_change.get("field"), value=value))
+        
+        entries.append(Entry(id=raw_entry.get("id"), changes=changes))
+    
+    return WebhookPayload(object=raw.get("object"), entry=entries)
 
 
 async def verify_get(request: Request):
@@ -22,98 +209,117 @@ async def verify_get(request: Request):
     Returns:
         Response avec le challenge ou 403
     """
-    mode = request.query_params.get("hub.mode")
-    token = request.query_params.get("hub.verify_token")
-    challenge = request.query_params.get("hub.challenge")
+    query_params = request.query_params
+    mode = query_params.get("hub.mode")
+    token = query_params.get("hub.verify_token") or ""
+    challenge = query_params.get("hub.challenge")
+    verify_token = Config.VERIFY_TOKEN
     
-    logger.info(f"Vérification webhook - Mode: {mode}, Token: {token[:10]}...")
+    logger.info("Vérification webhook - Mode: %s, Token: %s...", mode, token[:10])
     
-    if mode == "subscribe" and token == Config.VERIFY_TOKEN:
+    # Comparaison en temps constant (pas de fuite du jeton par le timing)
+    if mode == "subscribe" and hmac.compare_digest(token.encode(), verify_token.encode()):
         logger.info("✅ Webhook vérifié avec succès!")
-        return Response(content=challenge, media_type="text/plain")
+        # Le challenge (chiffres ASCII) est renvoyé déjà encodé
+        return PlainTextResponse((challenge or "").encode("utf-8"))
     
     logger.warning("❌ Échec vérification webhook - Token invalide")
     return Response(content="Forbidden", status_code=403)
 
 
-async def handle_post(data: dict):
+def verify_signature(body: bytes, signature_header: Optional[str]) -> bool:
+    """
+    Vérifie la signature X-Hub-Signature-256 d'un webhook Meta
+    
+    Args:
+        body: Corps brut de la requête
+        signature_header: Valeur de l'en-tête (format "sha256=<hex>")
+        
+    Returns:
+        True si la signature est valide ou si aucun secret n'est configuré
+    """
+    if _app_secret is None:
+        return True
+    
+    signature = (signature_header or "").removeprefix("sha256=")
+    expected = hmac.new(_app_secret, body, "sha256").hexdigest()
+    
+    # Comparaison en temps constant
+    return hmac.compare_digest(signature.encode(), expected.encode())
+
+
+async def handle_post(data: WebhookPayload):
     """
     Traite les événements entrants du webhook
     
     Args:
-        data: Payload JSON envoyé par Meta
+        data: Payload décodé (voir decode_payload)
     """
     try:
-        # Log des données reçues (debug)
-        logger.debug(f"Webhook reçu: {data}")
-        
-        # Structure du webhook Meta:
-        # {
-        #   "object": "whatsapp_business_account",
-        #   "entry": [{
-        #     "id": "...",
-        #     "changes": [{
-        #       "value": {
-        #         "messaging_product": "whatsapp",
-        #         "metadata": {...},
-        #         "contacts": [...],
-        #         "messages": [...]
-        #       },
-        #       "field": "messages"
-        #     }]
-        #   }]
-        # }
-        
-        entries = data.get("entry", [])
+        # Log des données reçues (debug ; repr du payload évitée sinon)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Webhook reçu: %s", data)
+        
+        entries = data.entry
         
         if not entries:
             logger.warning("Webhook sans entries")
             return
         
+        # Messages et statuts sont indépendants : traitement en parallèle
+        # (le nombre de messages simultanés reste borné par le sémaphore)
+        tasks = []
         for entry in entries:
-            changes = entry.get("changes", [])
-            
-            for change in changes:
-                value = change.get("value", {})
+            for change in entry.changes:
+                value = change.value
+                if value is None:
+                    continue
                 
                 # Traiter les messages
-                messages = value.get("messages", [])
-                for message in messages:
-                    await process_message(message, value)
+                tasks.extend(process_message(message, value) for message in value.messages)
                 
                 # Traiter les statuts (optionnel)
-                statuses = value.get("statuses", [])
-                for status in statuses:
-                    await process_status(status)
+                tasks.extend(process_status(status) for status in value.statuses)
+        
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"❌ Erreur traitement événement: {result}", exc_info=result)
                     
     except Exception as e:
         logger.error(f"❌ Erreur traitement webhook: {e}", exc_info=True)
 
 
-async def process_message(message: dict, value: dict):
+async def process_message(message: Message, value: Value):
     """
     Traite un message individuel
     
     Args:
-        message: Dict du message
-        value: Dict value du webhook (contient contacts, metadata, etc.)
+        message: Message décodé
+        value: Value du webhook (contient contacts, metadata, etc.)
     """
     try:
-        message_id = message.get("id")
-        from_number = message.get("from")
-        timestamp = message.get("timestamp")
-        message_type = message.get("type")
+        message_id = message.id
+        from_number = message.from_
+        timestamp = message.timestamp
+        message_type = message.type
         
+        # Formatage différé au handler ; champs structurés pour les logs JSON
         logger.info(
-            f"📨 Message reçu: ID={message_id}, "
-            f"De={from_number}, Type={message_type}"
+            "📨 Message reçu: ID=%s, De=%s, Type=%s",
+            message_id, from_number, message_type,
+            extra={
+                "message_id": message_id,
+                "from_number": from_number,
+                "message_type": message_type
+            }
         )
         
         # Extraire le nom du contact si disponible
-        contacts = value.get("contacts", [])
-        profile_name = "Utilisateur"
-        if contacts:
-            profile_name = contacts[0].get("profile", {}).get("name", "Utilisateur")
+        try:
+            profile_name = value.contacts[0].profile.name or "Utilisateur"
+        except (IndexError, AttributeError):
+            profile_name = "Utilisateur"
         
         # Construire l'objet message complet
         message_data = {
@@ -125,59 +331,35 @@ async def process_message(message: dict, value: dict):
         }
         
         # Ajouter le contenu selon le type
-        if message_type == "text":
-            message_data["text"] = message.get("text", {})
-        
-        elif message_type == "image":
-            message_data["image"] = message.get("image", {})
-        
-        elif message_type == "video":
-            message_data["video"] = message.get("video", {})
-        
-        elif message_type == "audio":
-            message_data["audio"] = message.get("audio", {})
-        
-        elif message_type == "document":
-            message_data["document"] = message.get("document", {})
-        
-        elif message_type == "interactive":
-            # Réponses aux boutons interactifs
-            message_data["interactive"] = message.get("interactive", {})
+        if message_type in _TYPED_FIELDS:
+            message_data[message_type] = getattr(message, message_type) or {}
         
-        elif message_type == "button":
-            # Ancienne façon de gérer les boutons
-            message_data["button"] = message.get("button", {})
-        
-        # Traiter le message via le processeur
-        await message_processor.process_incoming_message(message_data)
+        # Traiter le message via le processeur (concurrence bornée)
+        async with _message_semaphore:
+            await get_processor().process_incoming_message(message_data)
         
     except Exception as e:
         logger.error(f"❌ Erreur traitement message: {e}", exc_info=True)
 
 
-async def process_status(status: dict):
+async def process_status(status: Status):
     """
     Traite une mise à jour de statut (message envoyé, délivré, lu, etc.)
     
     Args:
-        status: Dict du statut
+        status: Statut décodé
     """
-    try:
-        status_type = status.get("status")
-        message_id = status.get("id")
-        recipient_id = status.get("recipient_id")
-        
+    status_type = status.status
+    
+    if logger.isEnabledFor(logging.DEBUG):
         logger.debug(
-            f"📊 Statut reçu: Type={status_type}, "
-            f"MessageID={message_id}, To={recipient_id}"
+            "📊 Statut reçu: Type=%s, MessageID=%s, To=%s",
+            status_type, status.id, status.recipient_id
         )
-        
-        # On peut logger ou stocker ces infos si nécessaire
-        # Statuts possibles: sent, delivered, read, failed
-        
-        if status_type == "failed":
-            errors = status.get("errors", [])
-            logger.warning(f"⚠️ Message {message_id} échoué: {errors}")
-        
-    except Exception as e:
-        logger.error(f"Erreur traitement statut: {e}")
\ No newline at end of file
+    
+    # On peut logger ou stocker ces infos si nécessaire
+    # Statuts possibles: sent, delivered, read, failed
+    
+    # Les erreurs inattendues remontent à handle_post (gather, return_exceptions)
+    if status_type == "failed":
+        logger.warning(f"⚠️ Message {status.id} échoué: {status.errors or []}")
\ No newline at end of file
@@ -2,27 +2,29 @@
 Point d'entrée principal de l'application
 Bot WhatsApp de détection de fake news et deepfakes
 """
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
-from app.webhook import verify_get, handle_post
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, ORJSONResponse
+from app.webhook import verify_get, handle_post, decode_payload, verify_signature
+from app.sender import close_client as close_sender_client
+from app.media_handler import MediaHandler, close_client as close_media_client
+from app.message_processor import warmup
 from app.config import Config
-from app.utils import setup_logger
+from app.utils import setup_logger, run_in_background
+import asyncio
 import sys
+from contextlib import asynccontextmanager
+from os.path import exists
 
 # Configuration du logger
 logger = setup_logger(__name__)
 
-# Créer l'application FastAPI
-app = FastAPI(
-    title="WhatsApp Fake News & Deepfake Detector",
-    description="Bot de détection de fake news et deepfakes via WhatsApp",
-    version="1.0.0"
-)
+# Accusé de réception des webhooks, sérialisé une fois pour toutes
+_ACK_BODY = b'{"status":"received"}'
 
 
-@app.on_event("startup")
-async def startup_event():
-    """Événement au démarrage de l'application"""
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Démarrage et arrêt de l'application"""
     logger.info("=" * 60)
     logger.info("🚀 Démarrage du Bot de Détection Fake News & Deepfakes")
     logger.info("=" * 60)
@@ -32,10 +34,20 @@ async def startup_event():
         Config.validate()
         logger.info("✅ Configuration validée")
         
+        if not Config.APP_SECRET:
+            logger.warning(
+                "⚠️ WHATSAPP_APP_SECRET absent : signatures des webhooks non vérifiées"
+            )
+        
         # Créer le dossier temporaire
-        Config.create_temp_dir()
+        await asyncio.to_thread(Config.create_temp_dir)
         logger.info("✅ Dossier temporaire créé")
         
+        # Précharger les modèles en tâche de fond : le serveur (et le health
+        # check) répond pendant le chargement
+        run_in_background(warmup())
+        logger.info("⏳ Préchargement des modèles lancé")
+        
         # Infos de configuration
         logger.info(f"📱 Phone Number ID: {Config.PHONE_NUMBER_ID}")
         logger.info(f"🔧 API Version: {Config.API_VERSION}")
@@ -50,25 +62,45 @@ async def startup_event():
         logger.error(f"❌ Erreur lors du démarrage: {e}")
         logger.error("Vérifiez votre fichier .env et vos variables d'environnement")
         sys.exit(1)
-
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Événement à l'arrêt de l'application"""
+    
+    # Nettoyage périodique des médias temporaires
+    handler = MediaHandler()
+    cleanup_task = asyncio.create_task(handler.run_periodic_cleanup())
+    
+    yield
+    
     logger.info("🛑 Arrêt du bot...")
     
+    cleanup_task.cancel()
+    
     # Nettoyage des fichiers temporaires
     try:
-        from app.media_handler import MediaHandler
-        handler = MediaHandler()
-        handler.cleanup_old_files(max_age_hours=0)  # Tout nettoyer
+        await handler.cleanup_old_files(max_age_hours=0)  # Tout nettoyer
         logger.info("✅ Fichiers temporaires nettoyés")
     except Exception as e:
         logger.warning(f"⚠️ Erreur nettoyage: {e}")
     
+    # Fermeture des clients HTTP partagés
+    try:
+        await close_sender_client()
+        await close_media_client()
+        logger.info("✅ Connexions HTTP fermées")
+    except Exception as e:
+        logger.warning(f"⚠️ Erreur fermeture connexions: {e}")
+    
     logger.info("👋 Bot arrêté proprement")
 
 
+# Créer l'application FastAPI
+app = FastAPI(
+    title="WhatsApp Fake News & Deepfake Detector",
+    description="Bot de détection de fake news et deepfakes via WhatsApp",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
+)
+
+
 @app.get("/")
 async def root():
     """
@@ -103,8 +135,7 @@ async def health_check():
         Config.validate()
         
         # Vérifier que les dossiers existent
-        import os
-        temp_dir_exists = os.path.exists(Config.TEMP_MEDIA_DIR)
+        temp_dir_exists = exists(Config.TEMP_MEDIA_DIR)
         
         return {
             "status": "healthy",
@@ -141,12 +172,34 @@ async def webhook_receive(request: Request):
     Endpoint de réception des événements (POST)
     Appelé par Meta quand un message arrive
     """
+    max_bytes = Config.MAX_WEBHOOK_BODY_KB * 1024
+    
+    # Refuser les corps trop volumineux avant lecture, puis après lecture
+    # (Content-Length peut être absent ou inexact)
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > max_bytes:
+        logger.warning(f"⚠️ Webhook refusé: corps trop volumineux ({content_length} octets)")
+        return Response(status_code=413)
+    
+    body = await request.body()
+    if len(body) > max_bytes:
+        logger.warning(f"⚠️ Webhook refusé: corps trop volumineux ({len(body)} octets)")
+        return Response(status_code=413)
+    
+    # Rejeter les requêtes non signées par Meta avant tout traitement
+    if not verify_signature(body, request.headers.get("x-hub-signature-256")):
+        logger.warning("❌ Webhook refusé: signature invalide")
+        return Response(status_code=401)
+    
     try:
-        data = await request.json()
-        await handle_post(data)
+        data = decode_payload(body)
+        
+        # Traitement en tâche de fond : Meta reçoit l'accusé immédiatement,
+        # sans attendre les téléchargements et analyses
+        run_in_background(handle_post(data))
         
         # Toujours retourner 200 pour que Meta ne réessaie pas
-        return {"status": "received"}
+        return Response(content=_ACK_BODY, media_type="application/json")
         
     except Exception as e:
         logger.error(f"Erreur traitement webhook: {e}", exc_info=True)
@@ -182,11 +235,15 @@ async def internal_error_handler(request: Request, exc):
 if __name__ == "__main__":
     import uvicorn
     
-    # Lancer le serveur
+    # Lancer le serveur ("auto" : uvloop et httptools s'ils sont installés,
+    # via uvicorn[standard] ; le rechargement auto impose un seul processus)
     uvicorn.run(
         "main:app",
         host=Config.HOST,
         port=Config.PORT,
+        loop="auto",
+        http="auto",
+        workers=None if Config.DEBUG else Config.WEB_CONCURRENCY,
         reload=Config.DEBUG,
-        log_level="info"
+        log_level="info" if Config.DEBUG else "warning"
     )
\ No newline at end of file